@@ -0,0 +1,106 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Background rendering of the annotated frames shown on the Gabriel debug server."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+from base64 import b64encode
+
+import cv2
+import numpy as np
+
+from disktray import config
+from disktray import zhuocv as zc
+
+
+class AnnotationWorker(threading.Thread):
+    """Draws the detections onto frames and encodes them, off the frame handling thread.
+
+    Only the latest submitted frame is kept, so frames that arrive while one is being rendered replace each other.
+    Frames are rendered at most max_fps times per second, shrunk to max_wh. While the detections do not change, the
+    previous annotated frame is reused for up to refresh_interval seconds.
+    """
+
+    def __init__(self, labels=config.LABELS, max_fps=config.ANNOTATION_MAX_FPS, max_wh=config.ANNOTATION_MAX_WH,
+                 jpeg_quality=config.ANNOTATION_JPEG_QUALITY, refresh_interval=config.ANNOTATION_REFRESH_INTERVAL):
+        super(AnnotationWorker, self).__init__()
+        self.daemon = True
+        self._labels = labels
+        self._min_interval = 1.0 / max_fps
+        self._max_wh = max_wh
+        self._jpeg_quality = jpeg_quality
+        self._refresh_interval = refresh_interval
+        self._cond = threading.Condition()
+        # latest (img, objects) waiting to be rendered
+        self._pending = None
+        # latest annotated frame, base64 encoded JPEG, until it is taken
+        self._encoded = None
+        self._last_objects = None
+        self._last_render_time = 0
+        self.stop = threading.Event()
+
+    def submit(self, img, objects):
+        """Queue a frame for rendering, replacing the frame waiting to be rendered if any. Does not block."""
+        with self._cond:
+            self._pending = (img, objects)
+            self._cond.notify()
+
+    def pop_latest(self):
+        """:return: the annotated frame rendered since the last call, or None"""
+        with self._cond:
+            encoded = self._encoded
+            self._encoded = None
+            return encoded
+
+    def run(self):
+        while not self.stop.is_set():
+            wait_time = self._last_render_time + self._min_interval - time.time()
+            if wait_time > 0:
+                self.stop.wait(wait_time)
+            with self._cond:
+                while self._pending is None and not self.stop.is_set():
+                    self._cond.wait(0.5)
+                if self.stop.is_set():
+                    break
+                img, objects = self._pending
+                self._pending = None
+
+            now = time.time()
+            if (self._last_objects is not None and np.array_equal(objects, self._last_objects) and
+                    now - self._last_render_time < self._refresh_interval):
+                continue
+            encoded = self._render(img, objects)
+            with self._cond:
+                self._encoded = encoded
+            self._last_objects = objects
+            self._last_render_time = now
+
+    def _render(self, img, objects):
+        scale = 1.0
+        if max(img.shape[:2]) > self._max_wh:
+            scale = float(self._max_wh) / max(img.shape[:2])
+            img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            objects = objects.copy()
+            objects[:, :4] *= scale
+        annotated_img = zc.vis_detections(img, objects, self._labels)
+        return b64encode(zc.cv_image2raw(annotated_img, jpeg_quality=self._jpeg_quality))
+
+    def terminate(self):
+        self.stop.set()
+        with self._cond:
+            self._cond.notify()
@@ -19,14 +19,13 @@ from __future__ import print_function
 
 import Queue
 import copy
+import functools
 import json
 import multiprocessing
 import pprint
 import socket
-import struct
 import sys
 import time
-from base64 import b64encode
 
 import cv2
 import gabriel
@@ -34,8 +33,21 @@ import gabriel.control
 import gabriel.proxy
 import numpy as np
 
+from disktray import annotation
 from disktray import config
+from disktray import detector
+from disktray import feedback
+from disktray import framering
+from disktray import objectclient
+from disktray import protocol
+from disktray import replay
+from disktray import roi
+from disktray import sampling
+from disktray import session
 from disktray import task
+from disktray import tracing
+from disktray import tracker
+from disktray import util
 from disktray import zhuocv as zc
 
 LOG = gabriel.logging.getLogger(__name__)
@@ -46,19 +58,21 @@ display_list = config.DISPLAY_LIST_TASK
 
 LOG_TAG = "DiskTray Proxy: "
 
+# header field with the time a frame was put into the image queue, removed before the header is sent back
+ARRIVAL_TIME_KEY = 'disktray_arrival_time'
 
-def reorder_objects(result):
-    # build a mapping between faster-rcnn recognized object order to a standard order
-    object_mapping = [-1] * len(config.LABELS)
-    with open("model/labels.txt") as f:
-        lines = f.readlines()
-        for idx, line in enumerate(lines):
-            line = line.strip()
-            object_mapping[idx] = config.LABELS.index(line)
 
-    for i in xrange(result.shape[0]):
-        result[i, -1] = object_mapping[int(result[i, -1] + 0.1)]
+def load_label_mapping(labels_path=config.MODEL_LABELS_PATH):
+    """Build the mapping from the faster-rcnn recognized object order to the standard order in config.LABELS."""
+    with open(labels_path) as f:
+        model_labels = [line.strip() for line in f.read().splitlines() if line.strip()]
+    return util.build_label_mapping(model_labels, config.LABELS)
 
+
+def reorder_objects(result, label_mapping):
+    # detections decoded from the wire are read-only
+    result = result.copy()
+    result[:, -1] = label_mapping[(result[:, -1] + 0.1).astype(np.intp)]
     return result
 
 
@@ -73,109 +87,354 @@ def display_verbal_guidance(text):
                          wait_time=config.DISPLAY_WAIT_TIME)
 
 
+class FrameQueue(Queue.Queue):
+    """Image queue that stamps frames with their arrival time, and tells whether a client has a newer frame waiting."""
+
+    def _put(self, item):
+        header, _ = item
+        if header is not None:
+            header[ARRIVAL_TIME_KEY] = time.time()
+        Queue.Queue._put(self, item)
+
+    def has_frame_of(self, header):
+        """Whether a frame of the same client as header is in the queue."""
+        client = header.get(config.SESSION_KEY)
+        with self.mutex:
+            return any(queued_header is not None and queued_header.get(config.SESSION_KEY) == client
+                       for queued_header, _ in self.queue)
+
+
 class DiskTrayApp(gabriel.proxy.CognitiveProcessThread):
-    def __init__(self, image_queue, output_queue, task_server_addr, engine_id, log_flag=True):
+    def __init__(self, image_queue, output_queue, task_server_addrs, engine_id, log_flag=True,
+                 max_in_flight=config.TASK_SERVER_MAX_IN_FLIGHT, connect_timeout=config.TASK_SERVER_CONNECT_TIMEOUT,
+                 frame_age_budget_ms=config.PROXY_FRAME_AGE_BUDGET_MS):
         super(DiskTrayApp, self).__init__(image_queue, output_queue, engine_id)
         self.log_flag = log_flag
         self.is_first_image = True
-        self._previous_instruction = {}
-        self._previous_instruction_timestamp = time.time()
         # minimum time interval between two duplicate instructions are given
         self._min_time_interval_between_duplicate_instructions = 20
-
-        # task initialization
-        self.task = task.Task()
+        self._max_in_flight = max_in_flight
+        # frames older than this when they are about to be sent, in seconds, are dropped
+        self._frame_age_budget = frame_age_budget_ms / 1000.0
+
+        # task initialization. Each client gets its own task session, the feedback images are shared.
+        self._feedback_images = feedback.FeedbackImageCache()
+        if config.IMAGE_GUIDANCE:
+            self._feedback_images.preload()
+        self.sessions = session.SessionManager(self._create_session)
+        self._label_mapping = load_label_mapping()
+
+        # per-frame latency of every stage in the proxy
+        self.tracer = tracing.Tracer('proxy')
+
+        # annotated images for the debug server are rendered in the background
+        self._annotator = None
+        if config.DEMO_SHOW_ANNOTATED_IMAGE:
+            self._annotator = annotation.AnnotationWorker()
+            self._annotator.start()
 
         # GPU machine offloaded part
+        self.object_client = None
+        self.recorder = replay.FrameRecorder(config.RECORD_PATH) if config.RECORD_PATH else None
         try:
-            self.task_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.task_server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.task_server_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self.task_server_sock.connect(task_server_addr)
-            LOG.info(LOG_TAG + "connected to task server")
+            self.object_client = objectclient.ObjectDetectionClient(task_server_addrs, max_in_flight=max_in_flight,
+                                                                    recorder=self.recorder,
+                                                                    connect_timeout=connect_timeout)
         except socket.error as e:
-            LOG.warning(LOG_TAG + "Failed to connect to task server at %s" % str(task_server_addr))
+            # without a task server the proxy cannot answer any frame
+            LOG.warning(LOG_TAG + "Failed to connect to task servers at %s" % str(task_server_addrs))
+            if self.recorder is not None:
+                self.recorder.close()
+            if self._annotator is not None:
+                self._annotator.terminate()
+            raise
+
+        # decoded frames go through shared memory if all task servers run on this host. Recordings need the JPEGs.
+        self._frame_ring = None
+        if (config.SHARED_MEMORY_FRAMES and self.recorder is None
+                and all(framering.is_available(host) for host, _ in task_server_addrs)):
+            self._frame_ring = framering.FrameRing.create(max(1, max_in_flight) * len(task_server_addrs) + 1,
+                                                          config.SHARED_MEMORY_SLOT_SIZE)
+            LOG.info(LOG_TAG + "sending frames through shared memory ring %s" % self._frame_ring.name)
+
+    def _create_session(self, session_id):
+        sampling_policy = sampling.SamplingPolicy() if config.ADAPTIVE_SAMPLING else None
+        object_tracker = tracker.IouTracker() if config.TRACKING else None
+        roi_selector = roi.RoiSelector() if config.ROI_DETECTION else None
+        return session.Session(session_id, task.Task(self._feedback_images), sampling_policy, object_tracker,
+                               roi_selector)
+
+    def _get_session(self, header):
+        return self.sessions.get(header.get(config.SESSION_KEY, self.engine_id))
 
     def terminate(self):
-        if self.task_server_sock is not None:
-            self.task_server_sock.close()
+        if self.object_client is not None:
+            self.object_client.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self._frame_ring is not None:
+            self._frame_ring.close()
+        if self._annotator is not None:
+            self._annotator.terminate()
         super(DiskTrayApp, self).terminate()
 
-    @staticmethod
-    def _recv_all(socket, recv_size):
-        data = ''
-        while len(data) < recv_size:
-            tmp_data = socket.recv(recv_size - len(data))
-            if tmp_data == None or len(tmp_data) == 0:
-                raise gabriel.proxy.ProxyError("Socket is closed")
-            data += tmp_data
-        return data
-
-    def _remove_duplicate_instructions(self, current_result):
+    def run(self):
+        if self._max_in_flight <= 1:
+            # wait for the detection result of every frame in handle()
+            return super(DiskTrayApp, self).run()
+
+        # pipelined mode: decode the next frame while the task server works on the previous ones. The results are
+        # processed and published from the receiving thread of the object client.
+        while not self.stop.wait(0.0001):
+            # frames wait in the image queue rather than here while the task server is busy, so that the next frame
+            # taken is the freshest one
+            if not self.object_client.wait_for_capacity(timeout=0.1):
+                continue
+            try:
+                (header, data) = self.data_queue.get(timeout=0.1)
+                if header is None or data is None:
+                    LOG.warning("header or data in data_queue is not valid!")
+                    continue
+            except Queue.Empty:
+                continue
+
+            LOG.info("received new image")
+            if self._drop_stale_frame(header):
+                self._publish(header, self._skip_frame(header))
+                continue
+            client_session = self._get_session(header)
+            if not self._should_detect(client_session):
+                if client_session.tracker is None:
+                    self._publish(header, self._skip_frame(header))
+                    continue
+                # the tracked objects are predicted once the results of the frames before have been processed
+                trace = self.tracer.new_frame()
+                trace.stamp('submit')
+                self.object_client.submit_local(functools.partial(self._on_objects_received, client_session, header,
+                                                                  None, trace, None))
+                continue
+            trace = self.tracer.new_frame()
+            img = self._preprocess(data, trace)
+            payload, slot = self._frame_payload(client_session, data, img, trace)
+            # the detection stage covers everything from here until the result has arrived, including the send
+            trace.stamp('submit')
+            self.object_client.submit(payload, functools.partial(self._on_objects_received, client_session, header,
+                                                                 img, trace, slot), client_session.wire_id)
+            # the result may already have been processed by now, so the send time does not go into the frame's trace
+            self.tracer.record('socket_send', trace.since('submit'))
+        LOG.info("[TERMINATE] Finish %s" % str(self))
+
+    def _on_objects_received(self, client_session, header, img, trace, slot, objects_data):
+        if slot is not None:
+            self._release_slot(slot, objects_data)
+        if objects_data is not None and protocol.is_dropped(objects_data):
+            self.tracer.count('dropped_by_server')
+            self._publish(header, self._skip_frame(header))
+            return
+        if objects_data is not None:
+            trace.add('detection', trace.since('submit'))
+        objects = self._get_objects(client_session, objects_data, trace)
+        result = self._process_objects(client_session, header, img, objects, trace)
+        self._publish(header, result)
+        self.tracer.finish(trace)
+
+    def _publish(self, header, result):
+        """Put a result into the output queue the same way CognitiveProcessThread does for the return of handle()."""
+        if result is None:
+            # a result marked useless
+            return
+        header[gabriel.Protocol_client.JSON_KEY_ENGINE_ID] = self.engine_id
+        if gabriel.Debug.TIME_MEASUREMENT:
+            header[gabriel.Protocol_measurement.JSON_KEY_APP_SENT_TIME] = time.time()
+        self.output_queue.put((json.dumps(header), result))
+
+    def _remove_duplicate_instructions(self, client_session, current_result):
         """Remove duplicate instructions to avoid flooding an user with a huge amount of same instructions"""
         # ignore the results that do not have any instructions
         if 'speech' not in current_result and 'image' not in current_result and 'video' not in current_result:
             return current_result
 
-        elapsed_time = time.time() - self._previous_instruction_timestamp
+        elapsed_time = time.time() - client_session.previous_instruction_timestamp
         next_previous_result = copy.copy(current_result)
         if elapsed_time < self._min_time_interval_between_duplicate_instructions:
-            if current_result == self._previous_instruction:
+            if current_result == client_session.previous_instruction:
                 LOG.info('Duplicated instructions! Removing speech, image and video instructions from {}'.format(
                     current_result))
                 current_result.pop('speech', None)
                 current_result.pop('image', None)
                 current_result.pop('video', None)
             else:
-                self._previous_instruction_timestamp = time.time()
+                client_session.previous_instruction_timestamp = time.time()
         else:
-            self._previous_instruction_timestamp = time.time()
-        self._previous_instruction = next_previous_result
+            client_session.previous_instruction_timestamp = time.time()
+        client_session.previous_instruction = next_previous_result
         return current_result
 
     def handle(self, header, data):
         # receive data from control VM
         LOG.info("received new image")
+        if self._drop_stale_frame(header):
+            return self._skip_frame(header)
+        client_session = self._get_session(header)
+        trace = self.tracer.new_frame()
+        if self._should_detect(client_session):
+            img = self._preprocess(data, trace)
+            payload, slot = self._frame_payload(client_session, data, img, trace)
+
+            # get object detection result
+            objects_data = protocol.CONNECTION_LOST
+            try:
+                with trace.stage('detection'):
+                    objects_data = self.object_client.request(payload, client_session.wire_id)
+            finally:
+                if slot is not None:
+                    self._release_slot(slot, objects_data)
+            if protocol.is_dropped(objects_data):
+                self.tracer.count('dropped_by_server')
+                return self._skip_frame(header)
+        elif client_session.tracker is not None:
+            img = None
+            objects_data = None
+        else:
+            return self._skip_frame(header)
+
+        # feed data to the task assistance app
+        objects = self._get_objects(client_session, objects_data, trace)
+        result = self._process_objects(client_session, header, img, objects, trace)
+        self.tracer.finish(trace)
+        return result
+
+    def _drop_stale_frame(self, header):
+        """Whether to drop a frame that is over its age budget or that a newer frame of the same client supersedes."""
+        arrival_time = header.pop(ARRIVAL_TIME_KEY, None)
+        if isinstance(self.data_queue, FrameQueue) and self.data_queue.has_frame_of(header):
+            reason = 'dropped_superseded'
+        elif arrival_time is not None and 0 < self._frame_age_budget < time.time() - arrival_time:
+            reason = 'dropped_stale'
+        else:
+            return False
+        self.tracer.count(reason)
+        return True
 
+    @staticmethod
+    def _should_detect(client_session):
+        # the sampling policy sees every frame, so that its intervals count frames and not the frames the tracker
+        # would detect; the tracker may still force a detection the policy skipped
+        sampled = None
+        if client_session.sampling_policy is not None:
+            sampled = client_session.sampling_policy.should_detect(client_session.task.current_state,
+                                                                   client_session.task.is_transition_close())
+        if client_session.tracker is not None:
+            return client_session.tracker.should_detect(sampled)
+        return sampled is None or sampled
+
+    @staticmethod
+    def _skip_frame(header):
+        # the client still gets an (empty) result for every frame it sends
         header['status'] = "nothing"
-        result = {}  # default
+        return json.dumps({})
 
+    @staticmethod
+    def _preprocess(data, trace):
         # preprocessing of input image
-        img = zc.raw2cv_image(data)
+        with trace.stage('jpeg_decode'):
+            img = zc.raw2cv_image(data)
         zc.check_and_display('input', img, display_list, resize_max=config.DISPLAY_MAX_PIXEL,
                              wait_time=config.DISPLAY_WAIT_TIME)
-
-        # get object detection result
-        # feed data to the task assistance app
-        packet = struct.pack("!I%ds" % len(data), len(data), data)
-        self.task_server_sock.sendall(packet)
-        result_size = struct.unpack("!I", self._recv_all(self.task_server_sock, 4))[0]
-        objects_data = self._recv_all(self.task_server_sock, result_size)
-
-        # the object detection result format is, for each line: [x1, y1, x2, y2, confidence, cls_idx]
-        objects = np.array(json.loads(objects_data))
-        objects = reorder_objects(objects)
+        return img
+
+    def _frame_payload(self, client_session, data, img, trace):
+        """:return: what to send to the task server for a frame, and the shared memory slot to release afterwards"""
+        region = None
+        if client_session.roi_selector is not None:
+            region = client_session.roi_selector.region(client_session.task.current_state, img.shape)
+        if self._frame_ring is None:
+            return self._with_region(region, data), None
+        if self._frame_ring.exhausted:
+            self._replace_frame_ring()
+        with trace.stage('shm_write'):
+            if region is not None:
+                img = roi.crop_image(img, region)
+            resized_img, resize_ratio = detector.resize_image(img)
+            slot, frame_ref = self._frame_ring.write(resized_img, resize_ratio)
+        if slot is None:
+            # no free slot, send the JPEG
+            return self._with_region(region, data), None
+        return self._with_region(region, frame_ref), slot
+
+    def _release_slot(self, slot, objects_data):
+        if objects_data is protocol.CONNECTION_LOST:
+            # the task server may still be reading the frame
+            self._frame_ring.quarantine(slot)
+        else:
+            self._frame_ring.release(slot)
+
+    def _replace_frame_ring(self):
+        # no slot is in use when they are all quarantined
+        old_ring = self._frame_ring
+        self._frame_ring = framering.FrameRing.create(old_ring.slots, old_ring.slot_size)
+        old_ring.close()
+        LOG.info(LOG_TAG + "replaced shared memory ring %s by %s" % (old_ring.name, self._frame_ring.name))
+
+    def _with_region(self, region, payload):
+        if region is None:
+            return payload
+        self.tracer.count('roi_frames')
+        return protocol.pack_region(region, payload)
+
+    def _get_objects(self, client_session, objects_data, trace):
+        """Decode the detection result of a frame, or predict the objects from the tracks if it was not detected.
+
+        The object format is, for each line: [x1, y1, x2, y2, confidence, cls_idx]
+        """
+        if objects_data is None:
+            with trace.stage('tracking'):
+                objects = client_session.tracker.predict()
+            LOG.info("tracked objects: %s" % objects)
+            return objects
+
+        with trace.stage('result_decode'):
+            objects = protocol.decode_detections(objects_data)
+            objects = reorder_objects(objects, self._label_mapping)
         LOG.info("object detection result: %s" % objects)
+        if client_session.tracker is not None:
+            with trace.stage('tracking'):
+                client_session.tracker.update(objects)
+        if client_session.roi_selector is not None:
+            client_session.roi_selector.update(objects)
+        return objects
+
+    def _process_objects(self, client_session, header, img, objects, trace):
+        header['status'] = "nothing"
+        result = {}  # default
 
         # for measurement, when the sysmbolic representation has been got
         if gabriel.Debug.TIME_MEASUREMENT:
             header[gabriel.Protocol_measurement.JSON_KEY_APP_SYMBOLIC_TIME] = time.time()
 
         # get instruction based on state
-        instruction, control = self.task.get_instruction(objects)
+        with trace.stage('state_machine'):
+            instruction, control = client_session.task.get_instruction(objects)
         if instruction['status'] != 'success':
             return json.dumps(result)
 
         # suppress duplicate instructions
-        self._remove_duplicate_instructions(instruction)
+        self._remove_duplicate_instructions(client_session, instruction)
+        if client_session.sampling_policy is not None and 'speech' in instruction:
+            client_session.sampling_policy.on_instruction()
 
-        # display annotated image if needed
-        if "object" in display_list:
+        # display annotated image if needed. Frames whose objects were tracked are not decoded
+        if img is not None and "object" in display_list:
             self._show_annotated_image(img, objects)
 
-        # return annotated image for demo display if needed
-        if config.DEMO_SHOW_ANNOTATED_IMAGE:
-            self._add_annotated_image_to_debug_server(header, img, objects)
+        # return annotated image for demo display if needed. The image sent along is the latest one rendered, not
+        # necessarily the one of this frame
+        if self._annotator is not None:
+            if img is not None:
+                self._annotator.submit(img, objects)
+            annotated_img = self._annotator.pop_latest()
+            if annotated_img is not None:
+                header[gabriel.Protocol_debug.JSON_KEY_ANNOTATED_INPUT_IMAGE] = annotated_img
 
         # send instructions back to client or the demo servers
         header['status'] = 'success'
@@ -183,8 +442,8 @@ class DiskTrayApp(gabriel.proxy.CognitiveProcessThread):
             result['speech'] = instruction['speech']
             display_verbal_guidance(result['speech'])
         if instruction.get('image', None) is not None:
-            feedback_image = b64encode(zc.cv_image2raw(instruction['image']))
-            result['image'] = feedback_image
+            # already base64 encoded by the feedback image cache
+            result['image'] = instruction['image']
         if instruction.get('video', None) is not None:
             result['video'] = instruction['video']
 
@@ -199,11 +458,6 @@ class DiskTrayApp(gabriel.proxy.CognitiveProcessThread):
         zc.check_and_display("object", img_object, display_list, resize_max=config.DISPLAY_MAX_PIXEL,
                              wait_time=config.DISPLAY_WAIT_TIME)
 
-    @staticmethod
-    def _add_annotated_image_to_debug_server(header, img, objects):
-        annotated_img_object = zc.vis_detections(img, objects, config.LABELS)
-        header[gabriel.Protocol_debug.JSON_KEY_ANNOTATED_INPUT_IMAGE] = b64encode(zc.cv_image2raw(annotated_img_object))
-
 
 def main():
     settings = gabriel.util.process_command_line(sys.argv[1:])
@@ -218,14 +472,15 @@ def main():
     ucomm_ip = service_list.get(gabriel.ServiceMeta.UCOMM_SERVER_IP)
     ucomm_port = service_list.get(gabriel.ServiceMeta.UCOMM_SERVER_PORT)
 
-    # object detection
+    # object detection. DiskTrayApp waits until the object server accepts connections, which it only does once the
+    # detectors are loaded
+    start_time = time.time()
     object_detection_process = gabriel.proxy.AppLauncher(config.OBJECT_DETECTION_BINARY_PATH, is_print=True)
     object_detection_process.start()
     object_detection_process.isDaemon = True
-    time.sleep(15)
 
     # image receiving thread
-    image_queue = Queue.Queue(gabriel.Const.APP_LEVEL_TOKEN_SIZE)
+    image_queue = FrameQueue(gabriel.Const.APP_LEVEL_TOKEN_SIZE)
     LOG.info("TOKEN SIZE OF OFFLOADING ENGINE: %d" % gabriel.Const.APP_LEVEL_TOKEN_SIZE)
     video_streaming = gabriel.proxy.SensorReceiveClient((video_ip, video_port), image_queue)
     video_streaming.start()
@@ -234,11 +489,13 @@ def main():
     # app proxy
     result_queue = multiprocessing.Queue()
 
-    task_server_ip = config.TASK_SERVER_IP
-    task_server_port = config.TASK_SERVER_PORT
-    app_proxy = DiskTrayApp(image_queue, result_queue, (task_server_ip, task_server_port), engine_id="DiskTray")
+    task_server_addrs = objectclient.parse_server_addrs(config.TASK_SERVERS)
+    app_proxy = DiskTrayApp(image_queue, result_queue, task_server_addrs, engine_id="DiskTray")
+    LOG.info(LOG_TAG + "started %.1f s after launching the object server" % (time.time() - start_time))
     app_proxy.start()
     app_proxy.isDaemon = True
+    # kill -USR1 logs the latency percentiles of the proxy
+    tracing.install_signal_handler(app_proxy.tracer)
 
     # result pub/sub
     result_pub = gabriel.proxy.ResultPublishClient((ucomm_ip, ucomm_port), result_queue)
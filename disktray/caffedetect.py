@@ -21,13 +21,11 @@ import matplotlib
 
 matplotlib.use('Agg')
 
-import json
-import numpy as np
 import os
 import sys
-import time
 
 from disktray import config
+from disktray import detector
 
 sys.path.append(os.path.join(config.FASTER_RCNN_ROOT, "tools"))
 # needed to intialize paths required by faster-rcnn
@@ -44,76 +42,39 @@ from fast_rcnn.nms_wrapper import nms
 sys.path.append(os.path.join(config.FASTER_RCNN_ROOT, "python"))
 import caffe
 
-current_milli_time = lambda: int(round(time.time() * 1000))
-
-# initialize caffe module
-faster_rcnn_config.TEST.HAS_RPN = True  # Use RPN for proposals
 prototxt = os.path.join(config.MODEL_DIR, 'faster_rcnn_test.pt')
 caffemodel = os.path.join(config.MODEL_DIR, 'model.caffemodel')
 
-if not os.path.isfile(caffemodel):
-    raise IOError(('{:s} not found.').format(caffemodel))
-
-if config.USE_GPU:
-    caffe.set_mode_gpu()
-    # 0 is the default GPU ID
-    caffe.set_device(0)
-    faster_rcnn_config.GPU_ID = 0
-else:
-    caffe.set_mode_cpu()
-
-net = caffe.Net(prototxt, caffemodel, caffe.TEST)
-
-# Warmup on a dummy image
-img = 128 * np.ones((300, 500, 3), dtype=np.uint8)
-for i in range(2):
-    _, _ = im_detect(net, img)
-
-
-# img will be modified in this function
-def detect_object(img, resize_ratio=1, confidence_threshold=0.5, nms_threshold=0.3):
-    global net
-    if config.USE_GPU:
-        caffe.set_mode_gpu()
-    else:
-        caffe.set_mode_cpu()
-
-    scores, boxes = im_detect(net, img)
 
-    result = None
-    for cls_idx in xrange(len(config.LABELS)):
-        cls_idx += 1  # because we skipped background
-        cls_boxes = boxes[:, 4 * cls_idx: 4 * (cls_idx + 1)]
-        cls_scores = scores[:, cls_idx]
-
-        # dets: detected results, each line is in [x1, y1, x2, y2, confidence] format
-        dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])).astype(np.float32)
-
-        # non maximum suppression
-        keep = nms(dets, nms_threshold)
-        dets = dets[keep, :]
-
-        # filter out low confidence scores
-        inds = np.where(dets[:, -1] >= confidence_threshold)[0]
-        dets = dets[inds, :]
-
-        # now change dets format to [x1, y1, x2, y2, confidence, cls_idx]
-        dets = np.hstack((dets, np.ones((dets.shape[0], 1)) * (cls_idx - 1)))
-
-        # combine with previous results (for other classes)
-        if result is None:
-            result = dets
+class CaffeDetector(detector.Detector):
+    """py-faster-rcnn detector, on the GPU if config.USE_GPU."""
+    name = detector.BACKEND_CAFFE
+
+    def __init__(self, prototxt=prototxt, caffemodel=caffemodel, use_gpu=config.USE_GPU, **kwargs):
+        super(CaffeDetector, self).__init__(**kwargs)
+        # initialize caffe module
+        faster_rcnn_config.TEST.HAS_RPN = True  # Use RPN for proposals
+        if not os.path.isfile(caffemodel):
+            raise IOError(('{:s} not found.').format(caffemodel))
+
+        self._use_gpu = use_gpu
+        if use_gpu:
+            # 0 is the default GPU ID
+            caffe.set_device(0)
+            faster_rcnn_config.GPU_ID = 0
+        self._set_mode()
+        self.net = caffe.Net(prototxt, caffemodel, caffe.TEST)
+
+    def _set_mode(self):
+        # the caffe mode is per thread
+        if self._use_gpu:
+            caffe.set_mode_gpu()
         else:
-            result = np.vstack((result, dets))
-
-    if result is not None:
-        result[:, :4] /= resize_ratio
-
-    return (img, result)
+            caffe.set_mode_cpu()
 
+    def predict(self, img):
+        self._set_mode()
+        return im_detect(self.net, img)
 
-def process(img, confidence_threshold, nms_threshold, resize_ratio=1, display_list=[]):
-    img_object, result = detect_object(img, resize_ratio, confidence_threshold=confidence_threshold,
-                                       nms_threshold=nms_threshold)
-    rtn_msg = {'status': 'success'}
-    return (rtn_msg, json.dumps(result.tolist()))
+    def nms(self, dets, thresh):
+        return nms(dets, thresh)
@@ -30,24 +30,133 @@ RECOGNIZE_ONLY = False
 # Port for communication between proxy and task server
 OBJECT_DETECTION_BINARY_PATH = find_executable('objectserver.py')
 TASK_SERVER_IP = "127.0.0.1"
-TASK_SERVER_PORT = 2722
+TASK_SERVER_PORT = int(os.getenv('DISKTRAY_TASK_SERVER_PORT', 2722))
+# The object server only accepts connections once its detectors are loaded and warmed up. The object server gives up
+# if its detectors are not ready after DETECTOR_STARTUP_TIMEOUT seconds. The proxy retries connecting for up to
+# TASK_SERVER_CONNECT_TIMEOUT seconds, by default a minute longer than the startup budget of the object server so that
+# a slow but successful startup is not given up on.
+DETECTOR_STARTUP_TIMEOUT = 600
+TASK_SERVER_CONNECT_TIMEOUT = float(os.getenv('DISKTRAY_TASK_SERVER_CONNECT_TIMEOUT', DETECTOR_STARTUP_TIMEOUT + 60))
+# Age budgets of a frame, in milliseconds, in the proxy (from its arrival until it is sent to the task server) and in
+# the task server (from its arrival until detection starts). Frames over budget, or with a newer frame of the same
+# client session already waiting, are dropped and answered with an empty result. 0, the default, disables the budget;
+# set DISKTRAY_PROXY_FRAME_AGE_BUDGET_MS and DISKTRAY_SERVER_FRAME_AGE_BUDGET_MS to e.g. 500 to drop late frames.
+PROXY_FRAME_AGE_BUDGET_MS = float(os.getenv('DISKTRAY_PROXY_FRAME_AGE_BUDGET_MS', 0))
+SERVER_FRAME_AGE_BUDGET_MS = float(os.getenv('DISKTRAY_SERVER_FRAME_AGE_BUDGET_MS', 0))
+# Number of frames the proxy may have outstanding at each task server. By default the proxy waits for the result of
+# every frame before taking the next one. Set DISKTRAY_TASK_SERVER_MAX_IN_FLIGHT to 2 or more to pipeline: the proxy
+# then decodes the next frame while the task server is still detecting objects in the previous ones.
+TASK_SERVER_MAX_IN_FLIGHT = int(os.getenv('DISKTRAY_TASK_SERVER_MAX_IN_FLIGHT', 1))
+# Task servers the proxy spreads the frames over, as comma separated host:port pairs. Every frame goes to the server
+# with the fewest frames outstanding. A server whose smoothed latency exceeds TASK_SERVER_EJECT_LATENCY_RATIO times
+# that of the fastest server gets no frames for TASK_SERVER_EJECT_INTERVAL seconds. Lost connections are retried at
+# growing intervals of up to TASK_SERVER_MAX_RETRY_INTERVAL seconds. A server that stops taking the data of a frame
+# for TASK_SERVER_SEND_TIMEOUT seconds is disconnected.
+TASK_SERVERS = os.getenv('DISKTRAY_TASK_SERVERS', '{}:{}'.format(TASK_SERVER_IP, TASK_SERVER_PORT))
+TASK_SERVER_EJECT_LATENCY_RATIO = float(os.getenv('DISKTRAY_TASK_SERVER_EJECT_LATENCY_RATIO', 3))
+TASK_SERVER_EJECT_INTERVAL = float(os.getenv('DISKTRAY_TASK_SERVER_EJECT_INTERVAL', 10))
+TASK_SERVER_MAX_RETRY_INTERVAL = 5.0
+TASK_SERVER_SEND_TIMEOUT = 5.0
+
+# Every client gets its own task session. Clients are told apart by this field of the frame header, frames without it
+# share the session of the engine.
+SESSION_KEY = os.getenv('DISKTRAY_SESSION_KEY', 'client_id')
+MAX_SESSIONS = int(os.getenv('DISKTRAY_MAX_SESSIONS', 16))
+# Seconds without frames after which a session is dropped
+SESSION_IDLE_TIMEOUT = 300
+
+# Directory to record the frames sent to object detection and their results to, for offline replay with
+# scripts/replay.py. Nothing is recorded if not set.
+RECORD_PATH = os.getenv('DISKTRAY_RECORD_PATH')
 
 # DEMO Related Setup
 DEMO_SHOW_ANNOTATED_IMAGE = bool(os.getenv("DISKTRAY_DEMO_SHOW_ANNOTATED_IMAGE", False))
+# The annotated images are rendered in the background, at most ANNOTATION_MAX_FPS per second and no larger than
+# ANNOTATION_MAX_WH. While the detections stay the same, the last annotated image is reused for up to
+# ANNOTATION_REFRESH_INTERVAL seconds.
+ANNOTATION_MAX_FPS = float(os.getenv('DISKTRAY_ANNOTATION_MAX_FPS', 5))
+ANNOTATION_MAX_WH = 480
+ANNOTATION_JPEG_QUALITY = 80
+ANNOTATION_REFRESH_INTERVAL = 1.0
+
+# Format of the detection results sent from the task server to the proxy, 'binary' or 'json'
+DETECTION_RESULT_FORMAT = os.getenv('DISKTRAY_DETECTION_RESULT_FORMAT', 'binary')
 
 # Configs for object detection
 USE_GPU = True
+# Number of detector processes in the object server. Each process loads its own copy of the net.
+DETECTOR_WORKERS = int(os.getenv('DISKTRAY_DETECTOR_WORKERS', 1))
+# Micro-batching in the object server. Frames arriving within BATCH_WINDOW_MS of the oldest waiting frame are handed
+# to a detector worker together, up to BATCH_MAX_SIZE frames. A window of 0 sends frames as soon as a worker is idle.
+BATCH_WINDOW_MS = float(os.getenv('DISKTRAY_BATCH_WINDOW_MS', 0))
+BATCH_MAX_SIZE = int(os.getenv('DISKTRAY_BATCH_MAX_SIZE', 4))
+# How often, in seconds, the batching latency and throughput counters are logged
+BATCH_STATS_LOG_INTERVAL = 10
+# Near-duplicate frame cache in the object server. With FRAME_CACHE on, a frame whose grayscale thumbnail of
+# FRAME_CACHE_SIGNATURE_SIZE x FRAME_CACHE_SIGNATURE_SIZE pixels differs by at most FRAME_CACHE_MAX_DISTANCE gray levels
+# on average from that of the last frame detected for the same client session, less than FRAME_CACHE_TTL_MS ago, gets
+# the detection result of that frame without running the detector.
+FRAME_CACHE = bool(os.getenv("DISKTRAY_FRAME_CACHE", False))
+FRAME_CACHE_SIGNATURE_SIZE = 16
+FRAME_CACHE_MAX_DISTANCE = float(os.getenv('DISKTRAY_FRAME_CACHE_MAX_DISTANCE', 3))
+FRAME_CACHE_TTL_MS = float(os.getenv('DISKTRAY_FRAME_CACHE_TTL_MS', 1000))
+# Frame quality gate in the object server (see zhuocv.frame_quality). With QUALITY_GATE on, frames are measured on a
+# grayscale copy of at most QUALITY_GATE_MAX_WH pixels. Frames sharper than QUALITY_GATE_MIN_SHARPNESS, and with at
+# most QUALITY_GATE_MAX_OVEREXPOSED of their pixels saturated, go to the detector. The others are dropped.
+# scripts/benchmark_quality_gate.py reports the measures of the frames of a recording, to choose the thresholds.
+QUALITY_GATE = bool(os.getenv("DISKTRAY_QUALITY_GATE", False))
+QUALITY_GATE_MAX_WH = 320
+QUALITY_GATE_MIN_SHARPNESS = float(os.getenv('DISKTRAY_QUALITY_GATE_MIN_SHARPNESS', 5))
+QUALITY_GATE_MAX_OVEREXPOSED = float(os.getenv('DISKTRAY_QUALITY_GATE_MAX_OVEREXPOSED', 0.5))
 
 # Whether or not to save the displayed image in a temporary directory
 SAVE_IMAGE = False
 
+# Adaptive frame sampling. In the task states listed in SAMPLING_INTERVALS, only every Nth frame is sent to object
+# detection unless a state transition is close. Other states detect every frame.
+ADAPTIVE_SAMPLING = bool(os.getenv("DISKTRAY_ADAPTIVE_SAMPLING", False))
+SAMPLING_INTERVALS = {
+    'nothing': 2,
+    'lever': 2,
+    'cap': 2,
+    'assembled': 2,
+    'finished': 10,
+}
+# Seconds during which frames are not detected after an instruction has been given
+SAMPLING_INSTRUCTION_COOLDOWN = 1.0
+SAMPLING_STATS_LOG_INTERVAL = 10
+
+# Object tracking between detections. With TRACKING on, the detector only runs on every DETECT_EVERY_N_FRAMES-th
+# frame and the objects of the frames in between are predicted by an IoU tracker. Tracks not detected again within
+# TRACKER_MAX_PREDICTED_FRAMES frames are dropped. With ADAPTIVE_SAMPLING on as well, the frames the sampling policy
+# picks are detected, and the tracker predicts the others but still forces a detection every DETECT_EVERY_N_FRAMES-th
+# frame while it has tracks.
+TRACKING = bool(os.getenv("DISKTRAY_TRACKING", False))
+DETECT_EVERY_N_FRAMES = int(os.getenv('DISKTRAY_DETECT_EVERY_N_FRAMES', 3))
+TRACKER_IOU_THRESHOLD = 0.3
+TRACKER_MAX_PREDICTED_FRAMES = 5
+
+# Region of interest detection (see disktray.roi). With ROI_DETECTION on, the frames of the task states in ROI_STATES
+# are only detected in the last box of one of ROI_ANCHOR_LABELS, grown by ROI_MARGIN of its size on every side. The
+# whole frame is detected again after ROI_MAX_MISSED_FRAMES detected frames without an anchor object.
+ROI_DETECTION = bool(os.getenv("DISKTRAY_ROI_DETECTION", False))
+ROI_STATES = ('pin', 'clamped')
+ROI_ANCHOR_LABELS = ('tray', 'assembled')
+ROI_MARGIN = float(os.getenv('DISKTRAY_ROI_MARGIN', 0.25))
+ROI_MAX_MISSED_FRAMES = 3
+
 # Threshold for computer vision module
 CONFIDENCE_THRESHOLD = 0.7
 NMS_THRESHOLD = 0.3
 
+# YAML task workflow (see disktray.workflow). The built-in DiskTray workflow is used if not set.
+WORKFLOW_PATH = os.getenv('DISKTRAY_WORKFLOW_PATH')
+
 # Whether to use video or image feedback
 IMAGE_GUIDANCE = False
 IMAGE_PATH_PREFIX = "feedback/images"
+# Maximum number of encoded feedback images kept in memory, 0 for no limit
+FEEDBACK_IMAGE_CACHE_SIZE = 0
 VIDEO_GUIDANCE = True
 VIDEO_SERVER_URL = os.getenv('DISKTRAY_VIDEO_SERVER_URL')
 if VIDEO_GUIDANCE and (VIDEO_SERVER_URL is None or len(VIDEO_SERVER_URL) == 0):
@@ -57,6 +166,12 @@ if VIDEO_GUIDANCE and (VIDEO_SERVER_URL is None or len(VIDEO_SERVER_URL) == 0):
 # Max image width and height
 IMAGE_MAX_WH = 640
 
+# Same-host frame transport. When the task server runs on this host, the proxy writes the decoded and resized frames
+# into shared memory (see disktray.framering) instead of sending the JPEG over TCP, so that frames are decoded once.
+SHARED_MEMORY_FRAMES = bool(os.getenv("DISKTRAY_SHARED_MEMORY_FRAMES", False))
+# Size of a shared memory frame slot, enough for a color frame of IMAGE_MAX_WH x IMAGE_MAX_WH
+SHARED_MEMORY_SLOT_SIZE = IMAGE_MAX_WH * IMAGE_MAX_WH * 3
+
 # ssh X Display flags. Better to use gabriel's debug webserver
 # To see annotated input stream with detected object, use 'object'
 DISPLAY_MAX_PIXEL = 400
@@ -69,15 +184,23 @@ DISPLAY_LIST_TASK = []
 # Used for cvWaitKey
 DISPLAY_WAIT_TIME = 1 if IS_STREAMING else 500
 
+# Detector backend of the object server (see disktray.detector): 'caffe' for py-faster-rcnn, 'opencv' for the OpenCV
+# DNN module on the CPU or 'stub' for a detector replaying the results of STUB_DETECTOR_RECORDING (see
+# disktray.replay), taking STUB_DETECTOR_DELAY_MS per frame.
+DETECTOR_BACKEND = os.getenv('DISKTRAY_DETECTOR_BACKEND', 'caffe')
+STUB_DETECTOR_RECORDING = os.getenv('DISKTRAY_STUB_DETECTOR_RECORDING')
+STUB_DETECTOR_DELAY_MS = float(os.getenv('DISKTRAY_STUB_DETECTOR_DELAY_MS', 0))
+
 # py-faster-rcnn based Object Detection Server
 FASTER_RCNN_ROOT = os.getenv('DISKTRAY_FASTER_RCNN_ROOT')
-if FASTER_RCNN_ROOT is None:
+if DETECTOR_BACKEND == 'caffe' and FASTER_RCNN_ROOT is None:
     raise ValueError('DISKTRAY_FASTER_RCNN_ROOT environment variable is not set. Please set it to be the path of '
                      'py-faster-rcnn package.')
 MODEL_DIR = 'model'
 if not os.path.exists(MODEL_DIR):
     raise ValueError('Model directory ({}) does not exist'.format(os.path.abspath(MODEL_DIR)))
-with open('model/labels.txt', 'r') as f:
+MODEL_LABELS_PATH = os.path.join(MODEL_DIR, 'labels.txt')
+with open(MODEL_LABELS_PATH, 'r') as f:
     content = f.read().splitlines()
     LABELS = content
 
@@ -0,0 +1,144 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Object detector backends of the object server.
+
+Every backend returns the detections of an image as a [[x1, y1, x2, y2, confidence, cls_idx]] float32 array, with
+cls_idx in the order of the model labels. The backend is selected with config.DETECTOR_BACKEND.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import time
+
+import cv2
+import numpy as np
+
+from disktray import config
+from disktray import postprocess
+from disktray import protocol
+from disktray import tracing
+
+BACKEND_CAFFE = 'caffe'
+BACKEND_OPENCV = 'opencv'
+BACKEND_STUB = 'stub'
+
+
+def resize_image(img, max_wh=config.IMAGE_MAX_WH):
+    """Shrink img so that neither side is larger than max_wh.
+
+    :return: (resized image, resize ratio)
+    """
+    resize_ratio = 1
+    if max(img.shape) > max_wh:
+        resize_ratio = float(max_wh) / max(img.shape[0], img.shape[1])
+        img = cv2.resize(img, (0, 0), fx=resize_ratio, fy=resize_ratio, interpolation=cv2.INTER_AREA)
+    return img, resize_ratio
+
+
+class Detector(object):
+    """Base class of the detector backends.
+
+    Subclasses implement predict(), which returns the per-class scores and boxes of the region proposals the same way
+    py-faster-rcnn's im_detect does. Thresholding and NMS are shared.
+    """
+    name = None
+
+    def __init__(self, confidence_threshold=config.CONFIDENCE_THRESHOLD, nms_threshold=config.NMS_THRESHOLD):
+        self.confidence_threshold = confidence_threshold
+        self.nms_threshold = nms_threshold
+
+    def predict(self, img):
+        """:return: (scores, boxes), of shape (n_proposals, n_classes) and (n_proposals, 4 * n_classes)"""
+        raise NotImplementedError()
+
+    def nms(self, dets, thresh):
+        return postprocess.py_nms(dets, thresh)
+
+    def warmup(self, iterations=2):
+        img = 128 * np.ones((300, 500, 3), dtype=np.uint8)
+        for _ in range(iterations):
+            self.predict(img)
+
+    def detect(self, img, resize_ratio=1, trace=None):
+        """Detect objects in an image that was shrunk by resize_ratio. The boxes are in original image coordinates."""
+        if trace is None:
+            trace = tracing.FrameTrace()
+        with trace.stage('im_detect'):
+            scores, boxes = self.predict(img)
+        with trace.stage('postprocess'):
+            result = postprocess.filter_detections(scores, boxes, self.confidence_threshold, self.nms_threshold,
+                                                   nms=self.nms)
+            result[:, :4] /= resize_ratio
+        return result
+
+    def detect_batch(self, imgs, resize_ratios=None, traces=None):
+        """Detect objects in a batch of images collected from one or more clients."""
+        if resize_ratios is None:
+            resize_ratios = [1] * len(imgs)
+        if traces is None:
+            traces = [None] * len(imgs)
+        return [self.detect(img, resize_ratio, trace) for img, resize_ratio, trace in zip(imgs, resize_ratios, traces)]
+
+
+class StubDetector(Detector):
+    """Detector for tests and benchmarks that does not look at the images.
+
+    Returns the detection results of a recording in a loop, or no detection if there is no recording, after
+    spending delay seconds on every image.
+    """
+    name = BACKEND_STUB
+
+    def __init__(self, recording=config.STUB_DETECTOR_RECORDING, delay=config.STUB_DETECTOR_DELAY_MS / 1000, **kwargs):
+        super(StubDetector, self).__init__(**kwargs)
+        self._delay = delay
+        results = [np.zeros((0, protocol.DETECTION_FIELDS), dtype=np.float32)]
+        if recording is not None:
+            from disktray import replay
+            frame_log = replay.FrameLog(recording)
+            # recordings may hold the empty responses of dropped frames
+            results = [protocol.decode_detections(detections).astype(np.float32)
+                       for _, _, detections in frame_log if not protocol.is_dropped(detections)] or results
+            frame_log.close()
+        self._results = itertools.cycle(results)
+
+    def warmup(self, iterations=2):
+        pass
+
+    def detect(self, img, resize_ratio=1, trace=None):
+        if trace is None:
+            trace = tracing.FrameTrace()
+        with trace.stage('im_detect'):
+            if self._delay > 0:
+                time.sleep(self._delay)
+            return next(self._results).copy()
+
+
+def create_detector(backend=config.DETECTOR_BACKEND, warmup=True, **kwargs):
+    """Create a detector, and warm it up unless warmup is False. The backend modules are only imported when selected."""
+    if backend == BACKEND_CAFFE:
+        from disktray import caffedetect
+        detector = caffedetect.CaffeDetector(**kwargs)
+    elif backend == BACKEND_OPENCV:
+        from disktray import dnndetect
+        detector = dnndetect.OpenCVDnnDetector(**kwargs)
+    elif backend == BACKEND_STUB:
+        detector = StubDetector(**kwargs)
+    else:
+        raise ValueError('Unknown detector backend: {}'.format(backend))
+    if warmup:
+        detector.warmup()
+    return detector
@@ -0,0 +1,160 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Detect objects with the OpenCV DNN module on the CPU, from the same Caffe model as disktray.caffedetect.
+
+OpenCV cannot run the python proposal layer of py-faster-rcnn, so the test prototxt is rewritten on load to use the
+built-in Proposal layer of OpenCV with the settings of rpn.proposal_layer. The input blobs and the box regression follow
+fast_rcnn.test.im_detect with the default py-faster-rcnn test settings, so that the detections match those of the caffe
+backend.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import tempfile
+
+import cv2
+import numpy as np
+
+from disktray import config
+from disktray import detector
+
+prototxt = os.path.join(config.MODEL_DIR, 'faster_rcnn_test.pt')
+caffemodel = os.path.join(config.MODEL_DIR, 'model.caffemodel')
+
+# py-faster-rcnn defaults: cfg.PIXEL_MEANS (BGR), cfg.TEST.SCALES and cfg.TEST.MAX_SIZE
+PIXEL_MEANS = np.array([102.9801, 115.9465, 122.7717], dtype=np.float32)
+TEST_SCALE = 600
+TEST_MAX_SIZE = 1000
+
+# rpn.proposal_layer.ProposalLayer with the default cfg.TEST settings, as an OpenCV Proposal layer
+PROPOSAL_PARAM = """proposal_param {{
+    feat_stride: {feat_stride}
+    base_size: 16
+    min_size: 16
+    ratio: 0.5
+    ratio: 1
+    ratio: 2
+    scale: 8
+    scale: 16
+    scale: 32
+    pre_nms_topn: 6000
+    post_nms_topn: 300
+    nms_thresh: 0.7
+  }}"""
+PYTHON_LAYER_TYPE = re.compile(r"""type:\s*['"]Python['"]""")
+PYTHON_PARAM = re.compile(r'python_param\s*\{[^}]*\}')
+FEAT_STRIDE = re.compile(r"""['"]?feat_stride['"]?\s*:\s*(\d+)""")
+
+
+def _layers(text):
+    """Yield the (start, end) offsets of the top level layer { ... } blocks of a prototxt."""
+    for match in re.finditer(r'\blayer\s*\{', text):
+        depth = 0
+        for end in range(match.end() - 1, len(text)):
+            if text[end] == '{':
+                depth += 1
+            elif text[end] == '}':
+                depth -= 1
+                if depth == 0:
+                    yield match.start(), end + 1
+                    break
+
+
+def native_proposal_prototxt(text):
+    """Replace the python proposal layer of a py-faster-rcnn prototxt by the Proposal layer of OpenCV."""
+    replaced = []
+    for start, end in _layers(text):
+        layer = text[start:end]
+        if PYTHON_LAYER_TYPE.search(layer) and 'ProposalLayer' in layer:
+            python_param = PYTHON_PARAM.search(layer).group(0)
+            feat_stride = FEAT_STRIDE.search(python_param)
+            proposal_param = PROPOSAL_PARAM.format(feat_stride=feat_stride.group(1) if feat_stride else 16)
+            layer = PYTHON_PARAM.sub(lambda _: proposal_param, PYTHON_LAYER_TYPE.sub("type: 'Proposal'", layer))
+            replaced.append((start, end, layer))
+    if not replaced:
+        raise ValueError('no python proposal layer found')
+    for start, end, layer in reversed(replaced):
+        text = text[:start] + layer + text[end:]
+    return text
+
+
+def bbox_transform_inv(boxes, deltas):
+    """Apply the per-class box regression deltas to the proposals, as fast_rcnn.bbox_transform does."""
+    widths = boxes[:, 2] - boxes[:, 0] + 1.0
+    heights = boxes[:, 3] - boxes[:, 1] + 1.0
+    ctr_x = boxes[:, 0] + 0.5 * widths
+    ctr_y = boxes[:, 1] + 0.5 * heights
+
+    pred_ctr_x = deltas[:, 0::4] * widths[:, np.newaxis] + ctr_x[:, np.newaxis]
+    pred_ctr_y = deltas[:, 1::4] * heights[:, np.newaxis] + ctr_y[:, np.newaxis]
+    pred_w = np.exp(deltas[:, 2::4]) * widths[:, np.newaxis]
+    pred_h = np.exp(deltas[:, 3::4]) * heights[:, np.newaxis]
+
+    pred_boxes = np.empty(deltas.shape, dtype=deltas.dtype)
+    pred_boxes[:, 0::4] = pred_ctr_x - 0.5 * pred_w
+    pred_boxes[:, 1::4] = pred_ctr_y - 0.5 * pred_h
+    pred_boxes[:, 2::4] = pred_ctr_x + 0.5 * pred_w
+    pred_boxes[:, 3::4] = pred_ctr_y + 0.5 * pred_h
+    return pred_boxes
+
+
+def clip_boxes(boxes, im_shape):
+    np.clip(boxes[:, 0::4], 0, im_shape[1] - 1, out=boxes[:, 0::4])
+    np.clip(boxes[:, 1::4], 0, im_shape[0] - 1, out=boxes[:, 1::4])
+    np.clip(boxes[:, 2::4], 0, im_shape[1] - 1, out=boxes[:, 2::4])
+    np.clip(boxes[:, 3::4], 0, im_shape[0] - 1, out=boxes[:, 3::4])
+    return boxes
+
+
+class OpenCVDnnDetector(detector.Detector):
+    """Faster R-CNN on the CPU with cv2.dnn."""
+    name = detector.BACKEND_OPENCV
+
+    def __init__(self, prototxt=prototxt, caffemodel=caffemodel, **kwargs):
+        super(OpenCVDnnDetector, self).__init__(**kwargs)
+        if not os.path.isfile(caffemodel):
+            raise IOError(('{:s} not found.').format(caffemodel))
+        with open(prototxt) as f:
+            deploy_prototxt = native_proposal_prototxt(f.read())
+        fd, deploy_path = tempfile.mkstemp(prefix='disktray-', suffix='.pt')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(deploy_prototxt)
+            self.net = cv2.dnn.readNetFromCaffe(deploy_path, caffemodel)
+        finally:
+            os.remove(deploy_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    def predict(self, img):
+        im_scale = float(TEST_SCALE) / min(img.shape[:2])
+        if np.round(im_scale * max(img.shape[:2])) > TEST_MAX_SIZE:
+            im_scale = float(TEST_MAX_SIZE) / max(img.shape[:2])
+        im = cv2.resize(img, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
+        blob = cv2.dnn.blobFromImage(im, mean=tuple(PIXEL_MEANS), swapRB=False, crop=False)
+        self.net.setInput(blob, 'data')
+        self.net.setInput(np.array([[im.shape[0], im.shape[1], im_scale]], dtype=np.float32), 'im_info')
+        # outputs are requested by layer name: the rois are the top of the proposal layer
+        rois, scores, box_deltas = self.net.forward(['proposal', 'cls_prob', 'bbox_pred'])
+
+        # proposals are (batch index, x1, y1, x2, y2) in scaled image coordinates
+        boxes = rois.reshape(-1, 5)[:, 1:] / im_scale
+        scores = scores.reshape(boxes.shape[0], -1)
+        box_deltas = box_deltas.reshape(boxes.shape[0], -1)
+        pred_boxes = clip_boxes(bbox_transform_inv(boxes, box_deltas), img.shape)
+        return scores, pred_boxes
@@ -0,0 +1,75 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Cache of the feedback images sent along with instructions."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import threading
+from base64 import b64encode
+
+import cv2
+from logzero import logger
+
+from disktray import config
+from disktray import zhuocv as zc
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class FeedbackImageCache(object):
+    """Instruction images as base64 encoded JPEG payloads, ready to be put into a result.
+
+    Images are read, encoded and added on first use. Beyond max_size images, the least recently used one is evicted.
+    """
+
+    def __init__(self, image_dir=config.IMAGE_PATH_PREFIX, max_size=config.FEEDBACK_IMAGE_CACHE_SIZE):
+        self._image_dir = image_dir
+        self._max_size = max_size
+        self._payloads = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def preload(self):
+        """Encode every image of the feedback directory, so that no instruction has to touch the disk."""
+        if not os.path.isdir(self._image_dir):
+            logger.warning('Feedback image directory {} does not exist'.format(os.path.abspath(self._image_dir)))
+            return
+        for image_name in sorted(os.listdir(self._image_dir)):
+            if os.path.splitext(image_name)[1].lower() in IMAGE_EXTENSIONS:
+                self.get(image_name)
+        logger.info('Loaded {} feedback images from {}'.format(len(self._payloads), self._image_dir))
+
+    def get(self, image_name):
+        """:return: base64 encoded JPEG of the image, or None if it cannot be read"""
+        with self._lock:
+            if image_name in self._payloads:
+                # mark as most recently used
+                payload = self._payloads.pop(image_name)
+                self._payloads[image_name] = payload
+                return payload
+
+        img = cv2.imread(os.path.join(self._image_dir, image_name))
+        if img is None:
+            logger.warning('Failed to read feedback image {}'.format(image_name))
+            return None
+        payload = b64encode(zc.cv_image2raw(img))
+
+        with self._lock:
+            self._payloads[image_name] = payload
+            while self._max_size > 0 and len(self._payloads) > self._max_size:
+                self._payloads.popitem(last=False)
+        return payload
@@ -0,0 +1,82 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Cache of the last detection result of every client session of the object server, to answer near-duplicate frames.
+
+A frame is summarized by a signature, a small grayscale thumbnail. A frame whose signature is close enough to the one of
+the last frame detected for the same client session, and detected recently enough, gets the cached result instead of
+running the detector, e.g. while the user holds a part still. A proxy connection carries the frames of all its client
+sessions, which are told apart by the session id of the frame header.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import time
+
+import cv2
+
+from disktray import config
+
+CacheEntry = collections.namedtuple('CacheEntry', ['signature', 'detections', 'detect_time', 'timestamp'])
+
+
+def frame_signature(img, size=config.FRAME_CACHE_SIGNATURE_SIZE):
+    """Grayscale thumbnail of an image, size x size pixels."""
+    thumbnail = cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA)
+    if thumbnail.ndim == 3:
+        thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+    return thumbnail
+
+
+def signature_distance(signature, other):
+    """Mean absolute difference between two signatures, in gray levels."""
+    return cv2.norm(signature, other, cv2.NORM_L1) / signature.size
+
+
+def matches(entry, signature, max_distance=config.FRAME_CACHE_MAX_DISTANCE):
+    """Whether a frame with the given signature is a near-duplicate of the frame cached in entry."""
+    return entry.signature.shape == signature.shape and signature_distance(entry.signature, signature) <= max_distance
+
+
+class FrameCache(object):
+    """Signature and encoded detection result of the last frame detected for every client session."""
+
+    def __init__(self, ttl_ms=config.FRAME_CACHE_TTL_MS):
+        self._ttl = ttl_ms / 1000.0
+        # client id -> session id -> CacheEntry
+        self._entries = {}
+
+    def lookup(self, client_id, session_id):
+        """:return: The entry of a client session if it is younger than the TTL, None otherwise"""
+        sessions = self._entries.get(client_id, {})
+        entry = sessions.get(session_id)
+        if entry is not None and time.time() - entry.timestamp > self._ttl:
+            del sessions[session_id]
+            return None
+        return entry
+
+    def store(self, client_id, session_id, signature, detections, detect_time):
+        """Remember the result of a frame that went through the detector, and the time it took to detect."""
+        now = time.time()
+        sessions = self._entries.setdefault(client_id, {})
+        # the sessions that have gone away are never looked up again
+        for expired_id in [other_id for other_id, entry in sessions.items() if now - entry.timestamp > self._ttl]:
+            del sessions[expired_id]
+        sessions[session_id] = CacheEntry(signature, detections, detect_time, now)
+
+    def forget(self, client_id):
+        """Forget the sessions of a client that disconnected."""
+        self._entries.pop(client_id, None)
@@ -0,0 +1,167 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Shared memory transport of decoded frames between the proxy and an object server on the same host.
+
+The proxy owns a ring of fixed size slots in a file under /dev/shm. It writes every decoded and resized frame into a
+free slot and sends the object server a small frame reference (ring name, slot, shape and resize ratio) in place of
+the JPEG. The object server reads the frame in place. A slot is released once the result of its frame has arrived, so
+it cannot be overwritten while the server is still reading it. When the connection to the server is lost before the
+result arrives, the server may still be reading the slot: it is quarantined, i.e. never used again. A ring whose slots
+are all quarantined is replaced by a new one.
+
+The object server only opens files under /dev/shm whose name is that of a frame ring.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import itertools
+import mmap
+import os
+import socket
+import struct
+import threading
+
+import numpy as np
+
+SHM_DIR = '/dev/shm'
+# every frame ring file is named like this, the object server does not open anything else
+RING_NAME_PREFIX = 'disktray-frames-'
+# frame references start with this, which JPEG data never does
+FRAME_REF_MAGIC = b'DTSHM'
+# slot, height, width, channels, resize ratio, followed by the ring name
+FRAME_REF = struct.Struct("!IIIIf")
+
+_ring_ids = itertools.count()
+
+
+def is_available(server_host):
+    """Whether frames can go through shared memory to an object server at server_host."""
+    try:
+        return os.path.isdir(SHM_DIR) and socket.gethostbyname(server_host).startswith('127.')
+    except socket.error:
+        return False
+
+
+def is_frame_ref(payload):
+    return payload[:len(FRAME_REF_MAGIC)] == FRAME_REF_MAGIC
+
+
+class FrameRing(object):
+    """Ring of frame slots in a shared memory file."""
+
+    def __init__(self, name, slots, slot_size, create=False):
+        if os.path.basename(name) != name:
+            raise ValueError('Invalid frame ring name: {}'.format(name))
+        self.name = name
+        self.slots = slots
+        self.slot_size = slot_size
+        self._path = os.path.join(SHM_DIR, name)
+        self._owner = create
+        with open(self._path, 'w+b' if create else 'r+b') as f:
+            if create:
+                f.truncate(slots * slot_size)
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._mm = mmap.mmap(f.fileno(), slots * slot_size)
+        self._free_slots = collections.deque(range(slots))
+        self._quarantined_slots = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, slots, slot_size, name=None):
+        if name is None:
+            name = '{}{}-{}'.format(RING_NAME_PREFIX, os.getpid(), next(_ring_ids))
+        return cls(name, slots, slot_size, create=True)
+
+    @classmethod
+    def open(cls, name, slot_size):
+        size = os.path.getsize(os.path.join(SHM_DIR, name))
+        return cls(name, size // slot_size, slot_size)
+
+    def write(self, img, resize_ratio=1):
+        """Copy a uint8 image into a free slot.
+
+        :param resize_ratio: ratio by which the image was shrunk, for the object server to scale the boxes back
+        :return: the slot to release once the result has arrived, and the frame reference to send to the object server.
+        (None, None) if the image does not fit into a slot or all slots are in use.
+        """
+        if img.dtype != np.uint8 or img.nbytes > self.slot_size:
+            return None, None
+        with self._lock:
+            if not self._free_slots:
+                return None, None
+            slot = self._free_slots.popleft()
+        np.ndarray(img.shape, dtype=np.uint8, buffer=self._mm, offset=slot * self.slot_size)[...] = img
+        height, width = img.shape[:2]
+        channels = img.shape[2] if img.ndim > 2 else 1
+        return slot, FRAME_REF_MAGIC + FRAME_REF.pack(slot, height, width, channels, resize_ratio) + self.name
+
+    def release(self, slot):
+        with self._lock:
+            self._free_slots.append(slot)
+
+    def quarantine(self, slot):
+        """Never use a slot again, because an object server may still be reading it."""
+        with self._lock:
+            self._quarantined_slots += 1
+
+    @property
+    def exhausted(self):
+        """Whether every slot is quarantined."""
+        with self._lock:
+            return self._quarantined_slots >= self.slots
+
+    def read(self, slot, shape):
+        """:return: the image in a slot, as a view of the shared memory"""
+        return np.ndarray(shape, dtype=np.uint8, buffer=self._mm, offset=slot * self.slot_size)
+
+    def close(self):
+        self._mm.close()
+        if self._owner:
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+
+
+class FrameRingReader(object):
+    """Object server side: resolves frame references, opening the rings of the proxies as they show up."""
+
+    def __init__(self, slot_size):
+        self._slot_size = slot_size
+        self._rings = {}
+
+    def read(self, frame_ref):
+        """:return: (image, resize ratio) of a frame reference. The image is only valid until the result is sent."""
+        slot, height, width, channels, resize_ratio = FRAME_REF.unpack_from(frame_ref, len(FRAME_REF_MAGIC))
+        name = bytes(frame_ref[len(FRAME_REF_MAGIC) + FRAME_REF.size:])
+        if not name.startswith(RING_NAME_PREFIX) or os.path.basename(name) != name:
+            raise ValueError('Invalid frame ring name: {!r}'.format(name))
+        ring = self._rings.get(name)
+        if ring is not None and os.stat(os.path.join(SHM_DIR, name)).st_ino != ring.inode:
+            # the proxy recreated its ring
+            ring.close()
+            ring = None
+        if ring is None:
+            ring = FrameRing.open(name, self._slot_size)
+            self._rings[name] = ring
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        return ring.read(slot, shape), resize_ratio
+
+    def close(self):
+        for ring in self._rings.values():
+            ring.close()
+        self._rings.clear()
@@ -0,0 +1,405 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Client side of the connections between the DiskTray proxy and the object detection servers."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import socket
+import struct
+import threading
+import time
+import traceback
+
+import gabriel
+
+from disktray import config
+from disktray import protocol
+
+LOG = gabriel.logging.getLogger(__name__)
+
+LOG_TAG = "DiskTray Object Client: "
+
+# weight of the latest response in the smoothed latency of a server
+LATENCY_SMOOTHING = 0.2
+# responses a server must have answered before its latency is compared with the others
+MIN_LATENCY_SAMPLES = 10
+
+
+def parse_server_addrs(text):
+    """Parse a comma separated list of host:port pairs into a list of (host, port) tuples."""
+    addrs = []
+    for addr in text.split(','):
+        host, port = addr.strip().rsplit(':', 1)
+        addrs.append((host, int(port)))
+    return addrs
+
+
+def connect(server_addr, timeout=0, retry_interval=0.1, max_retry_interval=1.0):
+    """Connect to the object detection server, retrying with a growing interval for up to timeout seconds."""
+    deadline = time.time() + timeout
+    while True:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect(server_addr)
+            return sock
+        except socket.error as e:
+            sock.close()
+            if time.time() + retry_interval > deadline:
+                raise
+            LOG.debug(LOG_TAG + "task server at %s not ready (%s), retrying" % (str(server_addr), str(e)))
+        time.sleep(retry_interval)
+        retry_interval = min(retry_interval * 2, max_retry_interval)
+
+
+def set_send_timeout(sock, timeout):
+    """Make sends on a blocking socket fail once no data could be sent for timeout seconds. Receives keep blocking."""
+    seconds = int(timeout)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                    struct.pack('ll', seconds, int((timeout - seconds) * 1000000)))
+
+
+class _Backend(object):
+    """One object detection server of the pool and the persistent connection to it."""
+
+    def __init__(self, addr):
+        self.addr = addr
+        # None while disconnected
+        self.sock = None
+        # held while a frame is sent, so that frames sent from different threads do not interleave
+        self.send_lock = threading.Lock()
+        # request id -> send time, for the frames outstanding at this server
+        self.in_flight = {}
+        # smoothed response time in seconds, None until the first response
+        self.latency = None
+        self.samples = 0
+        # the server gets no frames until this time if it has been ejected for being slow
+        self.ejected_until = 0
+        self.connect_attempts = 0
+        self.thread = None
+
+    def reset_latency(self):
+        self.latency = None
+        self.samples = 0
+
+
+class ObjectDetectionClient(object):
+    """Pipelined connections to a pool of object detection servers.
+
+    Every frame goes to the connected server with the fewest frames outstanding, up to max_in_flight frames per server.
+    Each server has a persistent connection with a thread that reads its responses and reconnects with a growing
+    interval when the connection is lost; frames outstanding at a lost server get a dropped response. A server whose
+    smoothed latency grows beyond eject_latency_ratio times that of the fastest other server is ejected: it gets no
+    frames for eject_interval seconds, unless no other server is connected.
+
+    Responses, which may arrive in any order and from any server, are matched back to their frames by request id and
+    the frame callbacks are invoked in the order the frames were submitted, so that the task state machine always sees
+    detection results in frame order.
+    """
+
+    def __init__(self, server_addrs, max_in_flight=1, recorder=None, connect_timeout=0, retry_interval=0.1,
+                 max_retry_interval=config.TASK_SERVER_MAX_RETRY_INTERVAL,
+                 eject_latency_ratio=config.TASK_SERVER_EJECT_LATENCY_RATIO,
+                 eject_interval=config.TASK_SERVER_EJECT_INTERVAL, send_timeout=config.TASK_SERVER_SEND_TIMEOUT):
+        """
+        :param server_addrs: list of (host, port) addresses of the object detection servers
+        :param max_in_flight: frames that may be outstanding at each server
+        :param recorder: optional replay.FrameRecorder that every frame sent and its result are recorded to
+        :param connect_timeout: seconds to wait for the first server to accept the connection, servers refuse
+        connections while they are still starting up
+        :param send_timeout: seconds after which a server that stops taking the data of a frame is disconnected
+        """
+        self._max_in_flight = max(1, max_in_flight)
+        self._retry_interval = retry_interval
+        self._max_retry_interval = max_retry_interval
+        self._eject_latency_ratio = eject_latency_ratio
+        self._eject_interval = eject_interval
+        self._send_timeout = send_timeout
+        self._cond = threading.Condition()
+        self._next_request_id = 0
+        # request id of the next frame whose callback is due
+        self._next_delivery_id = 0
+        # request id -> callback, for every frame whose callback has not been invoked yet
+        self._pending = {}
+        # request id -> payload, for responses that arrived ahead of an earlier frame
+        self._completed = {}
+        self._closed = False
+        # set on close, to interrupt the waits between reconnection attempts
+        self._closing = threading.Event()
+        self._recorder = recorder
+        # request id -> (send time, payload), for frames to be recorded
+        self._sent = {}
+        # held while callbacks are invoked, so that callbacks delivered from different threads never interleave
+        self._delivery_lock = threading.Lock()
+
+        self._backends = [_Backend(addr) for addr in server_addrs]
+        if not self._backends:
+            raise ValueError("No object detection server given")
+        start_time = time.time()
+        for backend in self._backends:
+            backend.thread = threading.Thread(target=self._run_backend, args=(backend,))
+            backend.thread.daemon = True
+            backend.thread.start()
+
+        deadline = start_time + connect_timeout
+        with self._cond:
+            while not any(backend.sock is not None for backend in self._backends):
+                remaining = deadline - time.time()
+                if remaining <= 0 and all(backend.connect_attempts > 0 for backend in self._backends):
+                    break
+                self._cond.wait(max(remaining, 0.1))
+            connected = sum(1 for backend in self._backends if backend.sock is not None)
+        if connected == 0:
+            self.close()
+            raise socket.error("No task server at %s accepted the connection" % str(server_addrs))
+        LOG.info(LOG_TAG + "connected to %d of %d task server(s) after %.1f s, up to %d frames in flight per server" % (
+            connected, len(self._backends), time.time() - start_time, self._max_in_flight))
+
+    @property
+    def in_flight(self):
+        with self._cond:
+            return len(self._pending)
+
+    def wait_for_capacity(self, timeout=None):
+        """Wait until a connected server has fewer than max_in_flight frames outstanding.
+
+        :return: whether a frame can be submitted without blocking
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pick_backend() is None and not self._closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            if self._closed:
+                raise protocol.ConnectionClosed("Connection to task server is closed")
+            return True
+
+    def _pick_backend(self):
+        """Choose the server for the next frame, None if every server is disconnected or busy.
+
+        Must be called with self._cond held.
+        """
+        now = time.time()
+        connected = [backend for backend in self._backends if backend.sock is not None]
+        healthy = [backend for backend in connected if backend.ejected_until <= now] or connected
+        candidates = [backend for backend in healthy if len(backend.in_flight) < self._max_in_flight]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: (len(backend.in_flight), backend.latency))
+
+    def submit(self, payload, callback, session_id=0):
+        """Send a frame to an object detection server without waiting for its result.
+
+        Blocks while every connected server already has max_in_flight frames outstanding.
+
+        :param payload: encoded frame
+        :param callback: called with the response payload from a receiving thread
+        :param session_id: wire id of the client session of the frame, see session.Session
+        :return: request id of the frame
+        """
+        with self._cond:
+            backend = self._pick_backend()
+            while backend is None and not self._closed:
+                self._cond.wait()
+                backend = self._pick_backend()
+            if self._closed:
+                raise protocol.ConnectionClosed("Connection to task server is closed")
+            request_id = self._next_request_id
+            self._next_request_id = (request_id + 1) % (protocol.MAX_REQUEST_ID + 1)
+            self._pending[request_id] = callback
+            backend.in_flight[request_id] = time.time()
+            if self._recorder is not None:
+                self._sent[request_id] = (time.time(), payload)
+            sock = backend.sock
+
+        # the pool stays available to the receiving threads while the frame is sent
+        try:
+            with backend.send_lock:
+                protocol.send_frame(sock, request_id, payload, session_id)
+        except socket.error as e:
+            # the receiving thread of the server answers its outstanding frames, this one included, as dropped
+            LOG.warning(LOG_TAG + "failed to send to task server at %s: %s" % (str(backend.addr), str(e)))
+            with self._cond:
+                if backend.sock is sock:
+                    self._disconnect(backend)
+        return request_id
+
+    def submit_local(self, callback):
+        """Queue a callback in frame order for a frame that is not sent to a server.
+
+        The callback is invoked with None once the results of all frames submitted before it have been delivered,
+        immediately if there are none.
+        """
+        with self._cond:
+            request_id = self._next_request_id
+            self._next_request_id = (request_id + 1) % (protocol.MAX_REQUEST_ID + 1)
+            self._pending[request_id] = callback
+        self._deliver(request_id, None)
+        return request_id
+
+    def request(self, payload, session_id=0):
+        """Send a frame and block until its result has arrived."""
+        result = []
+        done = threading.Event()
+
+        def _on_result(response):
+            result.append(response)
+            done.set()
+
+        self.submit(payload, _on_result, session_id)
+        while not done.wait(1):
+            if self._closed:
+                raise protocol.ConnectionClosed("Connection to task server is closed")
+        return result[0]
+
+    def _run_backend(self, backend):
+        """Keep a connection to one server open and read its responses, until the client is closed."""
+        retry_interval = self._retry_interval
+        while not self._closed:
+            try:
+                sock = connect(backend.addr)
+                set_send_timeout(sock, self._send_timeout)
+            except socket.error as e:
+                with self._cond:
+                    backend.connect_attempts += 1
+                    self._cond.notify_all()
+                LOG.debug(LOG_TAG + "task server at %s not reachable (%s), retrying in %.1f s" % (
+                    str(backend.addr), str(e), retry_interval))
+                self._closing.wait(retry_interval)
+                retry_interval = min(retry_interval * 2, self._max_retry_interval)
+                continue
+
+            with self._cond:
+                backend.connect_attempts += 1
+                if self._closed:
+                    sock.close()
+                    break
+                backend.sock = sock
+                backend.reset_latency()
+                backend.ejected_until = 0
+                self._cond.notify_all()
+            LOG.info(LOG_TAG + "connected to task server at %s" % str(backend.addr))
+            retry_interval = self._retry_interval
+
+            self._receive_loop(backend, sock)
+
+            with self._cond:
+                if backend.sock is sock:
+                    backend.sock = None
+                lost = list(backend.in_flight)
+                backend.in_flight.clear()
+                self._cond.notify_all()
+            sock.close()
+            if not self._closed:
+                LOG.warning(LOG_TAG + "lost connection to task server at %s, %d frame(s) dropped" % (
+                    str(backend.addr), len(lost)))
+            for request_id in lost:
+                self._deliver(request_id, protocol.CONNECTION_LOST)
+
+    def _receive_loop(self, backend, sock):
+        while True:
+            try:
+                request_id, _, payload = protocol.recv_frame(sock)
+            except (socket.error, protocol.ConnectionClosed) as e:
+                if not self._closed:
+                    LOG.debug(LOG_TAG + "connection to task server at %s closed: %s" % (str(backend.addr), str(e)))
+                return
+            with self._cond:
+                send_time = backend.in_flight.pop(request_id, None)
+                if send_time is None:
+                    LOG.warning(LOG_TAG + "dropping response to unknown request %d from %s" % (
+                        request_id, str(backend.addr)))
+                    continue
+                self._update_latency(backend, time.time() - send_time)
+                self._cond.notify_all()
+            self._deliver(request_id, payload)
+
+    def _update_latency(self, backend, latency):
+        """Update the smoothed latency of a server and eject it if it is much slower than the others.
+
+        Must be called with self._cond held.
+        """
+        if backend.latency is None:
+            backend.latency = latency
+        else:
+            backend.latency += LATENCY_SMOOTHING * (latency - backend.latency)
+        backend.samples += 1
+        if backend.samples < MIN_LATENCY_SAMPLES:
+            return
+        now = time.time()
+        others = [other.latency for other in self._backends
+                  if other is not backend and other.sock is not None and other.ejected_until <= now
+                  and other.samples >= MIN_LATENCY_SAMPLES]
+        if others and backend.latency > self._eject_latency_ratio * min(others):
+            LOG.warning(LOG_TAG + "ejecting task server at %s for %.0f s: latency %.1f ms, fastest server %.1f ms" % (
+                str(backend.addr), self._eject_interval, backend.latency * 1000, min(others) * 1000))
+            backend.ejected_until = now + self._eject_interval
+            # it is measured afresh once it gets frames again
+            backend.reset_latency()
+
+    def _deliver(self, request_id, payload):
+        """Record the result of a frame and invoke every callback that is due, in submission order."""
+        with self._delivery_lock:
+            ready = []
+            with self._cond:
+                if request_id not in self._pending:
+                    LOG.warning(LOG_TAG + "dropping response to unknown request %d" % request_id)
+                    return
+                self._completed[request_id] = payload
+                while self._next_delivery_id in self._completed:
+                    delivery_id = self._next_delivery_id
+                    ready.append((delivery_id, self._pending.pop(delivery_id), self._completed.pop(delivery_id)))
+                    self._next_delivery_id = (delivery_id + 1) % (protocol.MAX_REQUEST_ID + 1)
+                self._cond.notify_all()
+
+            for delivery_id, callback, response in ready:
+                if self._recorder is not None and response is not None:
+                    send_time, frame = self._sent.pop(delivery_id)
+                    # frames the server dropped have no detection result to replay
+                    if not protocol.is_dropped(response):
+                        self._recorder.record(send_time, frame, response)
+                try:
+                    callback(response)
+                except Exception:
+                    LOG.warning(LOG_TAG + traceback.format_exc())
+
+    def _disconnect(self, backend):
+        """Shut the connection to a server down, its receiving thread then cleans up.
+
+        Must be called with self._cond held.
+        """
+        if backend.sock is None:
+            return
+        try:
+            backend.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        backend.sock = None
+        self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._closing.set()
+            for backend in self._backends:
+                self._disconnect(backend)
+            self._cond.notify_all()
+        for backend in self._backends:
+            if backend.thread is not None and threading.current_thread() is not backend.thread:
+                backend.thread.join(1)
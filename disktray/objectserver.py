@@ -18,19 +18,27 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import errno
+import math
+import multiprocessing
+import os
 import select
 import socket
-import struct
 import sys
 import threading
 import time
 import traceback
 
-import cv2
 import gabriel
 
-from disktray import caffedetect
 from disktray import config
+from disktray import detector
+from disktray import framecache
+from disktray import framering
+from disktray import protocol
+from disktray import roi
+from disktray import tracing
 from disktray import zhuocv as zc
 
 config.setup(is_streaming=True)
@@ -40,83 +48,497 @@ LOG_TAG = "Disktray: "
 
 display_list = config.DISPLAY_LIST
 
+# what a detector worker sends back for every frame. The signature is None if the frame cache is off, the saved time is
+# None unless the result came from the frame cache, the rejection is None unless the quality gate rejected the frame or
+# the detection failed. Rejected frames are answered with protocol.DROPPED.
+FrameResult = collections.namedtuple('FrameResult', ['client_id', 'session_id', 'request_id', 'data', 'durations',
+                                                     'signature', 'saved_time', 'rejection'])
+
+
+def _load_frame(payload, frame_rings, trace):
+    """Decode and resize a JPEG frame, or read a frame the proxy already decoded and resized from shared memory.
+
+    Frames with a region of interest are cropped to the region before being resized. The proxy crops the frames it
+    puts in shared memory itself.
+
+    :return: (image, resize ratio, (x, y) position of the image in the frame)
+    """
+    region, payload = protocol.unpack_region(payload)
+    offset = (0, 0) if region is None else region[:2]
+    if framering.is_frame_ref(payload):
+        with trace.stage('shm_read'):
+            img, resize_ratio = frame_rings.read(payload)
+        return img, resize_ratio, offset
+    # decode at a reduced resolution when the frame, or its region of interest, is larger than needed
+    max_wh = config.IMAGE_MAX_WH
+    frame_size = zc.jpeg_size(payload) if region is not None else None
+    if frame_size is not None:
+        region_fraction = max((region[2] - region[0]) / frame_size[1], (region[3] - region[1]) / frame_size[0])
+        max_wh = int(math.ceil(max_wh / max(region_fraction, 1e-3)))
+    with trace.stage('server_decode'):
+        img, decode_scale = zc.raw2cv_image_reduced(payload, max_wh)
+    if region is not None:
+        with trace.stage('roi_crop'):
+            img = roi.crop_image(img, region, decode_scale)
+    with trace.stage('resize'):
+        img, resize_ratio = detector.resize_image(img)
+    return img, resize_ratio * decode_scale, offset
+
+
+def _check_quality(img):
+    """:return: why a frame is not worth detecting objects in, None if it is"""
+    sharpness, overexposure = zc.frame_quality(img, config.QUALITY_GATE_MAX_WH)
+    if overexposure > config.QUALITY_GATE_MAX_OVEREXPOSED:
+        return 'rejected_overexposed'
+    if sharpness < config.QUALITY_GATE_MIN_SHARPNESS:
+        return 'rejected_blurry'
+    return None
+
+
+def _handle_imgs(object_detector, imgs, resize_ratios, offsets, cache_entries, traces):
+    """Detect objects in the frames that pass the quality gate and are not near-duplicates of the cached frame of their
+    client.
+
+    The boxes are moved by the offset of their image, so that they are in frame coordinates.
+
+    :return: list of (encoded result, frame signature, detection time saved, rejection) per frame, as in FrameResult
+    """
+    return_data = [None] * len(imgs)
+    signatures = [None] * len(imgs)
+    saved_times = [None] * len(imgs)
+    rejections = [None] * len(imgs)
+    if config.QUALITY_GATE:
+        for idx, (img, trace) in enumerate(zip(imgs, traces)):
+            with trace.stage('quality_gate'):
+                rejections[idx] = _check_quality(img)
+            if rejections[idx] is not None:
+                return_data[idx] = protocol.DROPPED
+    if config.FRAME_CACHE:
+        for idx, (img, entry, trace) in enumerate(zip(imgs, cache_entries, traces)):
+            if rejections[idx] is not None:
+                continue
+            with trace.stage('cache_lookup'):
+                signatures[idx] = framecache.frame_signature(img)
+                if entry is not None and framecache.matches(entry, signatures[idx]):
+                    return_data[idx] = entry.detections
+                    saved_times[idx] = entry.detect_time
+
+    # get current state
+    misses = [idx for idx, data in enumerate(return_data) if data is None]
+    if misses:
+        results = object_detector.detect_batch([imgs[idx] for idx in misses],
+                                               resize_ratios=[resize_ratios[idx] for idx in misses],
+                                               traces=[traces[idx] for idx in misses])
+        for idx, state in zip(misses, results):
+            state[:, [0, 2]] += offsets[idx][0]
+            state[:, [1, 3]] += offsets[idx][1]
+            with traces[idx].stage('serialize'):
+                return_data[idx] = protocol.encode_detections(state, config.DETECTION_RESULT_FORMAT)
+    return zip(return_data, signatures, saved_times, rejections)
+
+
+def _detector_worker(conn):
+    """Entry point of a detector process.
+
+    Once the detector is loaded and warmed up, sends the time spent on both. Then receives batches of
+    (client_id, session_id, request_id, jpeg, frame cache entry) jobs from the pipe and sends back a list of FrameResult
+    together with the time spent on the batch. The detector is loaded once, when the process starts, so that only the
+    detector processes load the net.
+    """
+    start_time = time.time()
+    object_detector = detector.create_detector(warmup=False)
+    load_time = time.time() - start_time
+    object_detector.warmup()
+    warmup_time = time.time() - start_time - load_time
+    LOG.info(LOG_TAG + "%s detector loaded in %.1f s, warmed up in %.1f s" % (object_detector.name, load_time,
+                                                                             warmup_time))
+    conn.send((load_time, warmup_time))
+
+    frame_rings = framering.FrameRingReader(config.SHARED_MEMORY_SLOT_SIZE)
+    while True:
+        try:
+            batch = conn.recv()
+        except EOFError:
+            break
+        if batch is None:
+            break
+        start_time = time.time()
+        traces = [tracing.FrameTrace(request_id) for _, _, request_id, _, _ in batch]
+        try:
+            frames = [_load_frame(payload, frame_rings, trace) for (_, _, _, payload, _), trace in zip(batch, traces)]
+            imgs, resize_ratios, offsets = zip(*frames)
+            cache_entries = [entry for _, _, _, _, entry in batch]
+            return_data = _handle_imgs(object_detector, imgs, resize_ratios, offsets, cache_entries, traces)
+        except Exception as e:
+            LOG.warning(LOG_TAG + traceback.format_exc())
+            # an empty result would tell the task that nothing is in view
+            return_data = [(protocol.DROPPED, None, None, 'detection_failed')] * len(batch)
+        results = [FrameResult(client_id, session_id, request_id, data, trace.durations, signature, saved_time,
+                               rejection)
+                   for (client_id, session_id, request_id, _, _), (data, signature, saved_time, rejection), trace
+                   in zip(batch, return_data, traces)]
+        conn.send((results, time.time() - start_time))
+    frame_rings.close()
+
+
+class BatchStats(object):
+    """Latency and throughput counters of the micro-batching scheduler, logged periodically to tune the window."""
+
+    def __init__(self, log_interval=config.BATCH_STATS_LOG_INTERVAL):
+        self._log_interval = log_interval
+        self._reset(time.time())
+
+    def _reset(self, now):
+        self._period_start = now
+        self.batches = 0
+        self.frames = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.inference_time = 0.0
+        self.end_to_end_time = 0.0
+        self.cache_hits = 0
+        self.cache_saved_time = 0.0
+
+    def add_dispatch(self, batch_size, queue_times):
+        self.batches += 1
+        self.frames += batch_size
+        self.queue_time += sum(queue_times)
+        self.max_queue_time = max([self.max_queue_time] + list(queue_times))
+
+    def add_completion(self, inference_time, end_to_end_times):
+        self.inference_time += inference_time
+        self.end_to_end_time += sum(end_to_end_times)
+
+    def add_cache_hit(self, saved_time):
+        self.cache_hits += 1
+        self.cache_saved_time += saved_time
+
+    def maybe_log(self):
+        now = time.time()
+        elapsed = now - self._period_start
+        if elapsed < self._log_interval:
+            return
+        if self.frames > 0:
+            LOG.info(LOG_TAG + "batching: %.1f frames/s, %.2f frames/batch, queue wait %.1f ms (max %.1f ms), "
+                               "inference %.1f ms/frame, server latency %.1f ms/frame" % (
+                         self.frames / elapsed, self.frames / float(self.batches),
+                         self.queue_time / self.frames * 1000, self.max_queue_time * 1000,
+                         self.inference_time / self.frames * 1000, self.end_to_end_time / self.frames * 1000))
+            if self.cache_hits > 0:
+                LOG.info(LOG_TAG + "frame cache: %.0f%% hits, %.1f ms of detection saved per frame" % (
+                    self.cache_hits * 100.0 / self.frames, self.cache_saved_time / self.frames * 1000))
+        self._reset(now)
+
+
+class _ClientConnection(object):
+    """Non-blocking connection from a proxy, with its own read and write buffers."""
+
+    # maximum number of bytes read from a client per readiness event, so that a client sending a large frame does not
+    # hold up the others
+    RECV_SIZE = 256 * 1024
+
+    def __init__(self, client_id, sock):
+        self.client_id = client_id
+        self.sock = sock
+        self.sock.setblocking(0)
+        self._reader = protocol.FrameReader()
+        self._send_buffer = bytearray()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    @property
+    def has_pending_output(self):
+        return len(self._send_buffer) > 0
+
+    def read_frames(self):
+        """Read whatever is available on the socket.
+
+        :return: A list of (request_id, session_id, payload) tuples for the frames completed by this read
+        """
+        return self._reader.read_from(self.sock, self.RECV_SIZE)
+
+    def send(self, data):
+        self._send_buffer.extend(data)
+        self.flush()
+
+    def flush(self):
+        """Write as much of the buffered output as the socket accepts without blocking."""
+        while self._send_buffer:
+            try:
+                sent = self.sock.send(self._send_buffer)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise protocol.ConnectionClosed(str(e))
+            del self._send_buffer[:sent]
+
+    def close(self):
+        self.sock.close()
+
 
 class IkeaProcessing(threading.Thread):
-    def __init__(self):
+    """Event driven object detection server.
+
+    A single thread waits on an epoll set made of the listening socket, the client connections, the detector worker
+    pipes and a wakeup pipe used for shutdown. It sleeps until one of them is ready, so an idle server uses no CPU.
+    """
+
+    def __init__(self, num_workers=config.DETECTOR_WORKERS, batch_window_ms=config.BATCH_WINDOW_MS,
+                 batch_max_size=config.BATCH_MAX_SIZE, startup_timeout=config.DETECTOR_STARTUP_TIMEOUT,
+                 frame_age_budget_ms=config.SERVER_FRAME_AGE_BUDGET_MS, frame_cache=config.FRAME_CACHE):
+        start_time = time.time()
         self.stop = threading.Event()
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.server.bind(("", config.TASK_SERVER_PORT))
-        self.server.listen(10)  # actually we are only expecting one connection...
+        self.server.setblocking(0)
+
+        # client id -> connection, and file descriptor -> connection
+        self._clients = {}
+        self._client_fds = {}
+        self._next_client_id = 0
+
+        # pool of detector processes. Each one holds its own caffe net and works on one frame at a time.
+        self._workers = []
+        self._worker_conns = {}
+        for _ in range(max(1, num_workers)):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_detector_worker, args=(child_conn,))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self._workers.append(worker)
+            self._worker_conns[parent_conn.fileno()] = parent_conn
+        self._idle_worker_conns = collections.deque(self._worker_conns.values())
+        # (arrival time, job) of frames waiting for an idle worker
+        self._backlog = collections.deque()
+        # (client id, session id) -> number of frames of the client session in the backlog. Only the newest frame of a
+        # session is detected
+        self._backlog_frames = collections.Counter()
+        self._frame_age_budget = frame_age_budget_ms / 1000.0
+        # last detection result of every client session. The workers compare its frames with it to spot near-duplicates.
+        self._frame_cache = framecache.FrameCache() if frame_cache else None
+        LOG.info(LOG_TAG + "started %d detector worker(s)" % len(self._workers))
+
+        # the server only listens once every detector is ready. Until then, connections are refused and the proxy
+        # retries.
+        self._wait_for_workers(startup_timeout)
+        self.server.listen(10)
+        LOG.info(LOG_TAG + "ready for frames at port %d, %.1f s after start" % (config.TASK_SERVER_PORT,
+                                                                                 time.time() - start_time))
+
+        # frames arriving within the batch window are sent to a worker together, up to batch_max_size frames
+        self._batch_window = batch_window_ms / 1000.0
+        self._batch_max_size = max(1, batch_max_size)
+        self._batch_stats = BatchStats()
+        # per-frame latency of every stage in the server and its workers
+        self.tracer = tracing.Tracer('object server')
+        # (client id, request id) -> arrival time, for frames being processed by a worker
+        self._arrival_times = {}
+
+        # terminate() writes to this pipe to wake up the event loop
+        self._wakeup_r, self._wakeup_w = os.pipe()
+
+        self._epoll = select.epoll()
+        self._epoll.register(self.server.fileno(), select.EPOLLIN)
+        self._epoll.register(self._wakeup_r, select.EPOLLIN)
+        for fd in self._worker_conns:
+            self._epoll.register(fd, select.EPOLLIN)
 
         threading.Thread.__init__(self, target=self.run)
 
-    def run(self):
-        input_list = [self.server]
-        output_list = []
-        error_list = []
+    def _wait_for_workers(self, timeout):
+        """Wait until every detector worker has loaded and warmed up its detector."""
+        deadline = time.time() + timeout
+        max_load_time = max_warmup_time = 0
+        for conn in self._worker_conns.values():
+            try:
+                if not conn.poll(max(0, deadline - time.time())):
+                    raise RuntimeError("detector workers not ready after %d s" % timeout)
+                load_time, warmup_time = conn.recv()
+            except EOFError:
+                raise RuntimeError("a detector worker exited while loading its detector")
+            max_load_time = max(max_load_time, load_time)
+            max_warmup_time = max(max_warmup_time, warmup_time)
+        LOG.info(LOG_TAG + "%d detector worker(s) ready. Slowest detector load %.1f s, warm-up %.1f s" % (
+            len(self._worker_conns), max_load_time, max_warmup_time))
 
+    def run(self):
         LOG.info(LOG_TAG + "DiskTray object processing thread started")
         try:
-            while (not self.stop.wait(0.001)):
-                inputready, outputready, exceptready = \
-                    select.select(input_list, output_list, error_list, 0.001)
-                for s in inputready:
-                    if s == self.server:
-                        LOG.debug(LOG_TAG + "client connected")
-                        client, address = self.server.accept()
-                        input_list.append(client)
-                        output_list.append(client)
-                        error_list.append(client)
-                    else:
-                        self._receive(s)
+            while not self.stop.is_set():
+                try:
+                    events = self._epoll.poll(self._poll_timeout())
+                except IOError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                for fd, event in events:
+                    if fd == self.server.fileno():
+                        self._accept()
+                    elif fd in self._worker_conns:
+                        self._send_result(self._worker_conns[fd])
+                    elif fd in self._client_fds:
+                        self._handle_client_event(self._client_fds[fd], event)
+                self._dispatch_batches()
+        except EOFError:
+            LOG.warning(LOG_TAG + "a detector worker exited, the server stops accepting frames")
         except Exception as e:
             LOG.warning(LOG_TAG + traceback.format_exc())
             LOG.warning(LOG_TAG + "%s" % str(e))
             LOG.warning(LOG_TAG + "handler raises exception")
             LOG.warning(LOG_TAG + "Server is disconnected unexpectedly")
+        finally:
+            # the proxies must not connect to a server that no longer answers
+            self.server.close()
+            for client in self._clients.values():
+                client.close()
+            self._epoll.close()
+            # only this thread writes to the worker pipes
+            for worker_conn in self._worker_conns.values():
+                try:
+                    worker_conn.send(None)
+                except (IOError, EOFError):
+                    pass
         LOG.debug(LOG_TAG + "DiskTray object processing thread terminated")
 
-    @staticmethod
-    def _recv_all(socket, recv_size):
-        data = ''
-        while len(data) < recv_size:
-            tmp_data = socket.recv(recv_size - len(data))
-            if tmp_data == None or len(tmp_data) == 0:
-                raise Exception("Socket is closed")
-            data += tmp_data
-        return data
-
-    def _receive(self, sock):
+    def _accept(self):
         try:
-            img_size = struct.unpack("!I", self._recv_all(sock, 4))[0]
-            img = self._recv_all(sock, img_size)
-        except Exception as e:
+            sock, address = self.server.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        LOG.debug(LOG_TAG + "client connected from %s" % str(address))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = _ClientConnection(self._next_client_id, sock)
+        self._next_client_id += 1
+        self._clients[client.client_id] = client
+        self._client_fds[client.fileno()] = client
+        self._epoll.register(client.fileno(), select.EPOLLIN)
+
+    def _handle_client_event(self, client, event):
+        try:
+            if event & select.EPOLLOUT:
+                client.flush()
+                self._update_interest(client)
+            if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                for request_id, session_id, img in client.read_frames():
+                    self._backlog.append((time.time(), (client.client_id, session_id, request_id, img)))
+                    self._backlog_frames[(client.client_id, session_id)] += 1
+        except protocol.ConnectionClosed:
+            LOG.debug(LOG_TAG + "client disconnected")
+            self._remove_client(client)
+
+    def _update_interest(self, client):
+        """Only wait for a client to become writable while it has buffered output."""
+        mask = select.EPOLLIN
+        if client.has_pending_output:
+            mask |= select.EPOLLOUT
+        self._epoll.modify(client.fileno(), mask)
+
+    def _poll_timeout(self):
+        """Sleep until the batch window of the oldest waiting frame closes, or indefinitely if there is none."""
+        if not self._backlog or not self._idle_worker_conns:
+            return -1
+        return max(0, self._backlog[0][0] + self._batch_window - time.time())
+
+    def _batch_ready(self):
+        if len(self._backlog) >= self._batch_max_size:
+            return True
+        return time.time() - self._backlog[0][0] >= self._batch_window
+
+    def _dispatch_batches(self):
+        while self._idle_worker_conns and self._backlog and self._batch_ready():
+            now = time.time()
+            batch = []
+            queue_times = []
+            while self._backlog and len(batch) < self._batch_max_size:
+                arrival_time, job = self._backlog.popleft()
+                client_id, session_id, request_id, _ = job
+                self._backlog_frames[(client_id, session_id)] -= 1
+                if self._backlog_frames[(client_id, session_id)] > 0:
+                    self._drop(client_id, session_id, request_id, 'dropped_superseded')
+                    continue
+                del self._backlog_frames[(client_id, session_id)]
+                if self._frame_age_budget > 0 and now - arrival_time > self._frame_age_budget:
+                    self._drop(client_id, session_id, request_id, 'dropped_stale')
+                    continue
+                self._arrival_times[(client_id, request_id)] = arrival_time
+                queue_times.append(now - arrival_time)
+                self.tracer.record('queue', now - arrival_time)
+                cache_entry = None
+                if self._frame_cache is not None:
+                    cache_entry = self._frame_cache.lookup(client_id, session_id)
+                batch.append(job + (cache_entry,))
+            if not batch:
+                continue
+            self._idle_worker_conns.popleft().send(batch)
+            self._batch_stats.add_dispatch(len(batch), queue_times)
+
+    def _drop(self, client_id, session_id, request_id, reason):
+        """Answer a frame without detecting objects in it."""
+        self.tracer.count(reason)
+        self._send_to_client(client_id, session_id, request_id, protocol.DROPPED)
+
+    def _send_result(self, worker_conn):
+        results, inference_time = worker_conn.recv()
+        self._idle_worker_conns.append(worker_conn)
+
+        now = time.time()
+        end_to_end_times = []
+        for result in results:
+            end_to_end_times.append(now - self._arrival_times.pop((result.client_id, result.request_id), now))
+            self.tracer.record_durations(result.durations)
+            self.tracer.record('total', end_to_end_times[-1])
+            if result.rejection is not None:
+                self.tracer.count(result.rejection)
+            if self._frame_cache is not None and result.signature is not None:
+                self._update_frame_cache(result)
+        self._batch_stats.add_completion(inference_time, end_to_end_times)
+        self._batch_stats.maybe_log()
+
+        for result in results:
+            self._send_to_client(result.client_id, result.session_id, result.request_id, result.data)
+
+    def _update_frame_cache(self, result):
+        if result.saved_time is not None:
+            self.tracer.count('cache_hit')
+            self.tracer.record('cache_saved', result.saved_time)
+            self._batch_stats.add_cache_hit(result.saved_time)
             return
-        cv_img = zc.raw2cv_image(img)
-        return_data = self._handle_img(cv_img)
-
-        packet = struct.pack("!I%ds" % len(return_data), len(return_data), return_data)
-        sock.sendall(packet)
-
-    def _handle_img(self, img):
-        # preprocessing of input image
-        resize_ratio = 1
-        if max(img.shape) > config.IMAGE_MAX_WH:
-            resize_ratio = float(config.IMAGE_MAX_WH) / max(img.shape[0], img.shape[1])
-            img = cv2.resize(img, (0, 0), fx=resize_ratio, fy=resize_ratio, interpolation=cv2.INTER_AREA)
-        # get current state
-        rtn_msg, state = caffedetect.process(img, confidence_threshold=config.CONFIDENCE_THRESHOLD,
-                                             nms_threshold=config.NMS_THRESHOLD, resize_ratio=resize_ratio,
-                                             display_list=display_list)
-        if state is None:
-            return "None"
-
-        return state
+        self.tracer.count('cache_miss')
+        if result.client_id in self._clients:
+            self._frame_cache.store(result.client_id, result.session_id, result.signature, result.data,
+                                    result.durations.get('im_detect', 0) + result.durations.get('postprocess', 0))
+
+    def _send_to_client(self, client_id, session_id, request_id, return_data):
+        client = self._clients.get(client_id)
+        if client is None:
+            # the client disconnected while its frame was being processed
+            return
+        # echo the request id so that the proxy can match the result with its frame
+        try:
+            client.send(protocol.pack_frame(request_id, return_data, session_id))
+            self._update_interest(client)
+        except protocol.ConnectionClosed as e:
+            LOG.warning(LOG_TAG + "failed to send result to client %d: %s" % (client_id, str(e)))
+            self._remove_client(client)
+
+    def _remove_client(self, client):
+        self._epoll.unregister(client.fileno())
+        del self._client_fds[client.fileno()]
+        del self._clients[client.client_id]
+        if self._frame_cache is not None:
+            self._frame_cache.forget(client.client_id)
+        client.close()
 
     def terminate(self):
+        # the event loop shuts the workers down once it wakes up
         self.stop.set()
+        os.write(self._wakeup_w, b'x')
 
 
 def main():
@@ -124,9 +546,12 @@ def main():
     ikea_processing = IkeaProcessing()
     ikea_processing.start()
     ikea_processing.isDaemon = True
+    # kill -USR1 logs the latency percentiles of the server
+    tracing.install_signal_handler(ikea_processing.tracer)
 
     try:
-        while True:
+        # the event loop stops by itself if a detector worker dies
+        while ikea_processing.is_alive():
             time.sleep(1)
     except Exception as e:
         pass
@@ -0,0 +1,88 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Post-processing of raw Faster R-CNN outputs into detections.
+
+This module only depends on numpy so that it can be benchmarked without caffe.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def py_nms(dets, thresh):
+    """Pure numpy non maximum suppression, with the same semantics as py-faster-rcnn's nms.
+
+    :param dets: [[x1, y1, x2, y2, confidence]]
+    :return: indices of the kept detections, ordered by decreasing confidence
+    """
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = dets[:, 4].argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[order[1:]] - inter)
+        order = order[np.where(ovr <= thresh)[0] + 1]
+    return keep
+
+
+def filter_detections(scores, boxes, confidence_threshold, nms_threshold, nms=py_nms):
+    """Turn the per-proposal class scores and boxes of im_detect into detections.
+
+    Low confidence boxes are dropped for all classes at once before NMS, which gives the same result as thresholding
+    after NMS since a box can only be suppressed by a box with a higher score. NMS then runs once for all classes:
+    boxes are shifted by a per-class offset larger than any coordinate, so boxes of different classes never overlap.
+
+    :param scores: (num_proposals, num_classes + 1) array, column 0 is the background
+    :param boxes: (num_proposals, 4 * (num_classes + 1)) array
+    :param nms: function of (dets, threshold) returning the indices to keep
+    :return: [[x1, y1, x2, y2, confidence, cls_idx]] float32 array, grouped by class and sorted by decreasing
+    confidence within each class. cls_idx does not count the background.
+    """
+    num_proposals = scores.shape[0]
+    fg_scores = scores[:, 1:]
+    roi_inds, cls_inds = np.nonzero(fg_scores >= confidence_threshold)
+    if len(roi_inds) == 0:
+        return np.zeros((0, 6), dtype=np.float32)
+
+    cls_boxes = boxes.reshape(num_proposals, -1, 4)[roi_inds, cls_inds + 1]
+    dets = np.empty((len(roi_inds), 5), dtype=np.float32)
+    dets[:, :4] = cls_boxes
+    dets[:, :4] += (cls_inds * (cls_boxes.max() + 1))[:, np.newaxis]
+    dets[:, 4] = fg_scores[roi_inds, cls_inds]
+
+    keep = np.asarray(nms(dets, nms_threshold), dtype=np.intp)
+    # nms orders by confidence. A stable sort by class restores the per class grouping.
+    keep = keep[np.argsort(cls_inds[keep], kind='mergesort')]
+
+    result = np.empty((len(keep), 6), dtype=np.float32)
+    result[:, :4] = cls_boxes[keep]
+    result[:, 4] = dets[keep, 4]
+    result[:, 5] = cls_inds[keep]
+    return result
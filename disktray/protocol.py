@@ -0,0 +1,245 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Wire protocol between the DiskTray proxy and the object detection server.
+
+Every message on the task socket is a frame: a fixed size header followed by a payload. The header carries a request
+id so that several frames can be in flight on one connection. The server echoes the request id of a frame in its
+response, which lets responses arrive in any order.
+
+The payload of a response holds the detections of the frame. By default they are sent in a compact binary format: the
+number of detections followed by one row of little endian float32 [x1, y1, x2, y2, confidence, cls_idx] per
+detection. The JSON text format used originally is still available. An empty payload tells that the server dropped
+the frame without detecting objects in it.
+
+The payload of a request is the frame, a JPEG image or a shared memory frame reference. It may be preceded by a region
+of interest, in which case the server only detects objects in that region of the frame.
+
+Received payloads are read straight into a bytearray of their exact size with recv_into, so that they are neither
+copied nor reallocated on the way from the socket to cv2.imdecode or numpy.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import json
+import socket
+import struct
+
+import numpy as np
+
+# request id, session id, payload size. The session id tells the frames of the clients of a proxy apart.
+FRAME_HEADER = struct.Struct("!III")
+
+# request ids wrap around at the size of the header field
+MAX_REQUEST_ID = 2 ** 32 - 1
+
+# payloads up to this size are sent in one piece with their header, larger ones are not copied to be sent
+SMALL_PAYLOAD_SIZE = 64 * 1024
+
+RESULT_FORMAT_BINARY = 'binary'
+RESULT_FORMAT_JSON = 'json'
+
+# number of detections
+DETECTIONS_HEADER = struct.Struct("!I")
+DETECTION_DTYPE = np.dtype('<f4')
+DETECTION_FIELDS = 6
+
+# response payload of a frame dropped by the server
+DROPPED = b''
+
+
+class _ConnectionLost(bytes):
+    pass
+
+
+# what the client answers the frames outstanding at a server it lost the connection to, which may still be working on
+# them. It is dropped as well, but can be told apart from DROPPED by identity.
+CONNECTION_LOST = _ConnectionLost()
+
+# a request payload starting with this holds a region of interest, x1, y1, x2, y2 in frame pixels, then the frame
+REGION_MAGIC = b'DTROI'
+REGION = struct.Struct("!IIII")
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+def pack_frame(request_id, payload, session_id=0):
+    return FRAME_HEADER.pack(request_id, session_id, len(payload)) + payload
+
+
+def recv_all(sock, recv_size):
+    """Read exactly recv_size bytes from a blocking socket.
+
+    :return: bytearray holding the data
+    """
+    data = bytearray(recv_size)
+    view = memoryview(data)
+    received = 0
+    while received < recv_size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionClosed("Socket is closed")
+        received += n
+    return data
+
+
+def recv_frame(sock):
+    """Read one frame from a blocking socket.
+
+    :return: A tuple of (request_id, session_id, payload)
+    """
+    request_id, session_id, payload_size = FRAME_HEADER.unpack_from(recv_all(sock, FRAME_HEADER.size))
+    payload = recv_all(sock, payload_size)
+    return request_id, session_id, payload
+
+
+def send_all(sock, buffers):
+    """Send several buffers on a blocking socket without joining them, with scatter-gather I/O where available."""
+    if not hasattr(sock, 'sendmsg'):
+        # socket.sendmsg only exists from Python 3.3 on
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [memoryview(buf) for buf in buffers if len(buf) > 0]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views:
+            views[0] = views[0][sent:]
+
+
+def send_frame(sock, request_id, payload, session_id=0):
+    """Send one frame on a blocking socket."""
+    header = FRAME_HEADER.pack(request_id, session_id, len(payload))
+    if len(payload) <= SMALL_PAYLOAD_SIZE:
+        sock.sendall(header + payload)
+    else:
+        send_all(sock, (header, payload))
+
+
+class FrameReader(object):
+    """Incremental reader of frames from a non-blocking socket.
+
+    The header of a frame is read into a small reusable buffer, then its payload straight into a bytearray of the
+    payload size, which is handed out once complete.
+    """
+
+    def __init__(self):
+        self._header = bytearray(FRAME_HEADER.size)
+        self._reset()
+
+    def _reset(self):
+        self._request_id = None
+        self._session_id = None
+        self._buffer = self._header
+        self._view = memoryview(self._header)
+        self._received = 0
+
+    def read_from(self, sock, max_size):
+        """Read what is available on the socket, up to about max_size bytes.
+
+        :return: A list of (request_id, session_id, payload) tuples for the frames completed by this read
+        """
+        frames = []
+        total_received = 0
+        while total_received < max_size:
+            requested = len(self._buffer) - self._received
+            try:
+                n = sock.recv_into(self._view[self._received:])
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise ConnectionClosed(str(e))
+            if n == 0:
+                raise ConnectionClosed("Socket is closed")
+            total_received += n
+            self._received += n
+            if self._received == len(self._buffer):
+                self._next_part(frames)
+            if n < requested:
+                # the socket is drained. The poller reports it again if more data has arrived since
+                break
+        return frames
+
+    def _next_part(self, frames):
+        if self._request_id is not None:
+            frames.append((self._request_id, self._session_id, self._buffer))
+            self._reset()
+            return
+        request_id, session_id, payload_size = FRAME_HEADER.unpack_from(self._header)
+        if payload_size == 0:
+            frames.append((request_id, session_id, bytearray()))
+            self._reset()
+            return
+        self._request_id = request_id
+        self._session_id = session_id
+        self._buffer = bytearray(payload_size)
+        self._view = memoryview(self._buffer)
+        self._received = 0
+
+
+def is_dropped(payload):
+    return len(payload) == 0
+
+
+def pack_region(region, payload):
+    """Prefix a frame payload with the region of interest to detect objects in."""
+    return REGION_MAGIC + REGION.pack(*region) + payload
+
+
+def unpack_region(payload):
+    """:return: (region of interest or None, frame payload)"""
+    if payload[:len(REGION_MAGIC)] != REGION_MAGIC:
+        return None, payload
+    region = REGION.unpack_from(payload, len(REGION_MAGIC))
+    return region, payload[len(REGION_MAGIC) + REGION.size:]
+
+
+def encode_detections(objects, result_format=RESULT_FORMAT_BINARY):
+    """Serialize detections for the wire.
+
+    :param objects: [[x1, y1, x2, y2, confidence, cls_idx]] array, or None if there is no detection
+    """
+    if objects is None:
+        objects = np.zeros((0, DETECTION_FIELDS), dtype=DETECTION_DTYPE)
+    if result_format == RESULT_FORMAT_JSON:
+        return json.dumps(np.asarray(objects).tolist())
+    if result_format != RESULT_FORMAT_BINARY:
+        raise ValueError('Unknown detection result format: {}'.format(result_format))
+    objects = np.ascontiguousarray(objects, dtype=DETECTION_DTYPE)
+    return DETECTIONS_HEADER.pack(objects.shape[0]) + objects.tobytes()
+
+
+def decode_detections(payload):
+    """Deserialize detections in either format.
+
+    Binary payloads are not copied: the returned array is a view of payload. A JSON payload always starts
+    with '[', which as the first byte of the binary header would mean over a billion detections, so the two formats
+    cannot be confused.
+
+    :return: [[x1, y1, x2, y2, confidence, cls_idx]] array with one row per detection
+    """
+    if payload[:1] == b'[':
+        objects = np.array(json.loads(bytes(payload)), dtype=np.float32)
+        return objects.reshape(-1, DETECTION_FIELDS)
+    num_objects = DETECTIONS_HEADER.unpack_from(payload)[0]
+    objects = np.frombuffer(payload, dtype=DETECTION_DTYPE, count=num_objects * DETECTION_FIELDS,
+                            offset=DETECTIONS_HEADER.size)
+    return objects.reshape(num_objects, DETECTION_FIELDS)
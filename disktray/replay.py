@@ -0,0 +1,170 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Recording of the frames sent to object detection and their results, and replay of such recordings.
+
+A recording is a directory with two files: 'frames.dat' holds the JPEG frames and the detection result payloads back to
+back, and 'index.dat' holds one fixed size entry per frame with its receive time and the offsets and sizes of both.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+import socket
+import struct
+import threading
+import time
+
+import gabriel
+
+from disktray import config
+from disktray import protocol
+
+LOG = gabriel.logging.getLogger(__name__)
+
+LOG_TAG = "DiskTray Replay: "
+
+DATA_FILE_NAME = 'frames.dat'
+INDEX_FILE_NAME = 'index.dat'
+# timestamp, offset of the frame in the data file, frame size, detection result size
+INDEX_ENTRY = struct.Struct("!dQII")
+
+
+class FrameRecorder(object):
+    """Appends frames and their detection results to a recording."""
+
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._data_file = open(os.path.join(path, DATA_FILE_NAME), 'ab')
+        self._index_file = open(os.path.join(path, INDEX_FILE_NAME), 'ab')
+        self._lock = threading.Lock()
+        LOG.info(LOG_TAG + "recording frames to %s" % path)
+
+    def record(self, timestamp, frame, detections):
+        """
+        :param timestamp: time the frame was received
+        :param frame: JPEG encoded frame
+        :param detections: detection result payload, as sent by the object server
+        """
+        with self._lock:
+            self._data_file.seek(0, os.SEEK_END)
+            offset = self._data_file.tell()
+            self._data_file.write(frame)
+            self._data_file.write(detections)
+            self._data_file.flush()
+            self._index_file.write(INDEX_ENTRY.pack(timestamp, offset, len(frame), len(detections)))
+            self._index_file.flush()
+
+    def close(self):
+        with self._lock:
+            self._data_file.close()
+            self._index_file.close()
+
+
+class FrameLog(object):
+    """Read access to a recording. Entries are (timestamp, frame, detections) tuples."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE_NAME), 'rb') as f:
+            index_data = f.read()
+        n_entries = len(index_data) // INDEX_ENTRY.size
+        self._index = [INDEX_ENTRY.unpack_from(index_data, i * INDEX_ENTRY.size) for i in xrange(n_entries)]
+        self._data_file = open(os.path.join(path, DATA_FILE_NAME), 'rb')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, idx):
+        timestamp, offset, frame_size, detections_size = self._index[idx]
+        with self._lock:
+            self._data_file.seek(offset)
+            data = self._data_file.read(frame_size + detections_size)
+        return timestamp, data[:frame_size], data[frame_size:]
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    @property
+    def frame_rate(self):
+        """Average frame rate of the recording, in frames per second."""
+        if len(self._index) < 2:
+            return 0
+        duration = self._index[-1][0] - self._index[0][0]
+        return (len(self._index) - 1) / duration if duration > 0 else 0
+
+    def close(self):
+        self._data_file.close()
+
+
+def frame_key(frame):
+    return hashlib.sha1(frame).digest()
+
+
+class RecordedDetectionServer(threading.Thread):
+    """Stand-in for the object detection server, answering every frame with its recorded detection result.
+
+    Frames are looked up by content, frames that are not in the recording get an empty result. detection_delay seconds
+    are spent on every frame to simulate the detector.
+    """
+
+    def __init__(self, frame_log, server_addr=(config.TASK_SERVER_IP, config.TASK_SERVER_PORT), detection_delay=0):
+        super(RecordedDetectionServer, self).__init__()
+        self.daemon = True
+        self._detections = {frame_key(frame): detections for _, frame, detections in frame_log}
+        self._empty_detections = protocol.encode_detections(None, config.DETECTION_RESULT_FORMAT)
+        self._detection_delay = detection_delay
+        self.stop = threading.Event()
+
+        self._server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server_sock.bind(server_addr)
+        self._server_sock.listen(5)
+        self._server_sock.settimeout(0.5)
+        self.server_addr = self._server_sock.getsockname()
+        LOG.info(LOG_TAG + "serving %d recorded detection results at %s" % (len(self._detections),
+                                                                             str(self.server_addr)))
+
+    def run(self):
+        while not self.stop.is_set():
+            try:
+                client_sock, addr = self._server_sock.accept()
+            except socket.timeout:
+                continue
+            handler = threading.Thread(target=self._serve, args=(client_sock,))
+            handler.daemon = True
+            handler.start()
+        self._server_sock.close()
+
+    def _serve(self, client_sock):
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while not self.stop.is_set():
+                request_id, session_id, frame = protocol.recv_frame(client_sock)
+                if self._detection_delay > 0:
+                    time.sleep(self._detection_delay)
+                detections = self._detections.get(frame_key(frame), self._empty_detections)
+                protocol.send_frame(client_sock, request_id, detections, session_id)
+        except (socket.error, protocol.ConnectionClosed):
+            pass
+        finally:
+            client_sock.close()
+
+    def terminate(self):
+        self.stop.set()
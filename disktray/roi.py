@@ -0,0 +1,80 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Region of interest detection of small parts.
+
+In the task states that check small parts, such as the pin, the proxy asks the object server to only detect objects
+in the region around the last box of an anchor object, the tray or the assembled tray. The server crops that region out
+of the frame before shrinking it to the input size of the net, so that small parts get more pixels than when the whole
+frame is shrunk.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+
+import numpy as np
+
+from disktray import config
+
+
+def crop_image(img, region, scale=1.0):
+    """Copy of the region (x1, y1, x2, y2) of an image, given in the coordinates of the image shrunk by scale."""
+    x1, y1, x2, y2 = (int(round(value * scale)) for value in region)
+    return np.ascontiguousarray(img[y1:y2, x1:x2])
+
+
+class RoiSelector(object):
+    """Chooses the region of the next frame of a client to detect objects in.
+
+    The anchor box is the most confident box of an anchor label in the last detected frame. It is forgotten after
+    max_missed_frames detected frames without an anchor object, so that the whole frame is detected again.
+    """
+
+    def __init__(self, states=config.ROI_STATES, anchor_labels=config.ROI_ANCHOR_LABELS, margin=config.ROI_MARGIN,
+                 max_missed_frames=config.ROI_MAX_MISSED_FRAMES, labels=config.LABELS):
+        self._states = frozenset(states)
+        self._anchor_indices = np.array([labels.index(label) for label in anchor_labels if label in labels],
+                                        dtype=np.intp)
+        self._margin = margin
+        self._max_missed_frames = max_missed_frames
+        self._anchor_box = None
+        self._missed_frames = 0
+
+    def update(self, objects):
+        """Take the anchor box from the objects detected in a frame, in frame coordinates."""
+        anchors = objects[np.in1d((objects[:, 5] + 0.1).astype(np.intp), self._anchor_indices)]
+        if len(anchors) == 0:
+            self._missed_frames += 1
+            if self._missed_frames >= self._max_missed_frames:
+                self._anchor_box = None
+            return
+        self._missed_frames = 0
+        self._anchor_box = anchors[np.argmax(anchors[:, 4]), :4].copy()
+
+    def region(self, state, frame_shape):
+        """:return: (x1, y1, x2, y2) region of a frame to detect objects in, None to detect the whole frame"""
+        anchor_box = self._anchor_box
+        if state not in self._states or anchor_box is None:
+            return None
+        x1, y1, x2, y2 = anchor_box
+        margin_x = (x2 - x1) * self._margin
+        margin_y = (y2 - y1) * self._margin
+        height, width = frame_shape[:2]
+        region = (max(0, int(x1 - margin_x)), max(0, int(y1 - margin_y)),
+                  min(width, int(math.ceil(x2 + margin_x))), min(height, int(math.ceil(y2 + margin_y))))
+        if region[2] - region[0] < 2 or region[3] - region[1] < 2:
+            return None
+        return region
@@ -0,0 +1,74 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Adaptive sampling of the frames sent to object detection."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+from logzero import logger
+
+from disktray import config
+
+
+class SamplingPolicy(object):
+    """Decides which frames go through object detection, depending on the task state.
+
+    Each state has a detection interval: with an interval of 3, one frame out of three is detected. Right after an
+    instruction has been given nothing is expected to change while the user acts on it, so frames are skipped for a
+    cooldown period. When a transition is close, i.e. the objects the current state waits for are in view, every frame
+    is detected so that consecutive frame counts are not slowed down.
+    """
+
+    def __init__(self, intervals=config.SAMPLING_INTERVALS, instruction_cooldown=config.SAMPLING_INSTRUCTION_COOLDOWN,
+                 log_interval=config.SAMPLING_STATS_LOG_INTERVAL):
+        self._intervals = intervals
+        self._instruction_cooldown = instruction_cooldown
+        self._log_interval = log_interval
+        self._cooldown_end_time = 0
+        self._frames_since_detection = 0
+        self.detected_frames = 0
+        self.skipped_frames = 0
+        self._last_log_time = time.time()
+
+    def should_detect(self, state, transition_close):
+        now = time.time()
+        if now < self._cooldown_end_time:
+            detect = False
+        else:
+            interval = 1 if transition_close else self._intervals.get(state, 1)
+            self._frames_since_detection += 1
+            detect = self._frames_since_detection >= interval
+
+        if detect:
+            self._frames_since_detection = 0
+            self.detected_frames += 1
+        else:
+            self.skipped_frames += 1
+        self._maybe_log(now)
+        return detect
+
+    def on_instruction(self):
+        self._cooldown_end_time = time.time() + self._instruction_cooldown
+        # detect the first frame after the cooldown
+        self._frames_since_detection = float('inf')
+
+    def _maybe_log(self, now):
+        if now - self._last_log_time < self._log_interval:
+            return
+        self._last_log_time = now
+        logger.info('Adaptive sampling: {} frames detected, {} frames skipped'.format(self.detected_frames,
+                                                                                      self.skipped_frames))
@@ -0,0 +1,95 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Per-client sessions, so that one proxy can guide several workers at once."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import itertools
+import threading
+import time
+
+from logzero import logger
+
+from disktray import config
+
+# numeric ids the task servers know the sessions by, see protocol.FRAME_HEADER
+_wire_ids = itertools.count(1)
+
+
+class Session(object):
+    """State of one client: its task state machine, duplicate instruction suppression, frame sampling, object
+    tracking and region of interest."""
+    __slots__ = ('session_id', 'wire_id', 'task', 'sampling_policy', 'tracker', 'roi_selector',
+                 'previous_instruction', 'previous_instruction_timestamp', 'last_active_time')
+
+    def __init__(self, session_id, task, sampling_policy=None, tracker=None, roi_selector=None):
+        self.session_id = session_id
+        self.wire_id = next(_wire_ids) % (2 ** 32)
+        self.task = task
+        self.sampling_policy = sampling_policy
+        self.tracker = tracker
+        self.roi_selector = roi_selector
+        self.previous_instruction = {}
+        self.previous_instruction_timestamp = time.time()
+        self.last_active_time = time.time()
+
+
+class SessionManager(object):
+    """Bounded set of sessions keyed by client id.
+
+    Sessions are created on the first frame of a client and evicted after idle_timeout seconds without frames. When
+    max_sessions are active, a new client evicts the least recently active session.
+    """
+
+    def __init__(self, session_factory, max_sessions=config.MAX_SESSIONS, idle_timeout=config.SESSION_IDLE_TIMEOUT):
+        """
+        :param session_factory: function of a session id returning a new Session
+        """
+        self._session_factory = session_factory
+        self._max_sessions = max(1, max_sessions)
+        self._idle_timeout = idle_timeout
+        # session id -> session, ordered from least to most recently active
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id):
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                if len(self._sessions) >= self._max_sessions:
+                    evicted_id, _ = self._sessions.popitem(last=False)
+                    logger.warning('Too many sessions ({}). Evicted session {}'.format(self._max_sessions,
+                                                                                      evicted_id))
+                session = self._session_factory(session_id)
+                logger.info('New session {}. {} active sessions'.format(session_id, len(self._sessions) + 1))
+            session.last_active_time = now
+            self._sessions[session_id] = session
+            return session
+
+    def _evict_idle(self, now):
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_active_time < self._idle_timeout:
+                break
+            del self._sessions[session_id]
+            logger.info('Session {} has been idle for {:.0f} seconds. Evicted'.format(
+                session_id, now - session.last_active_time))
@@ -14,30 +14,46 @@
 # ==============================================================================
 """DiskTray Application Task State Machine.
 
-This file contains the task workflow, computer vision checks, and instructions for the DiskTray assistance.
+This file runs the task workflow compiled from disktray.workflow and contains the computer vision checks the workflow
+refers to.
 """
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import collections
-import os
 import time
 
-import cv2
 import gabriel
+import numpy as np
 from logzero import logger
 
-from disktray import config, util
+from disktray import config, feedback, util, workflow
 
 
 class Task(object):
-    def __init__(self):
-        self.current_state = "start"
-        # how many consecutive frames an object has appeared
-        self._cumulative_object_counters = collections.defaultdict(int)
-        self._minimal_seconds_between_runs = 20
-        self._last_run_finish_time = -float("inf")
+    # there is one Task per client session
+    __slots__ = ('current_state', '_workflow', '_feedback_images', '_cumulative_object_counters', '_state_entry_time')
+
+    def __init__(self, feedback_images=None, task_workflow=None):
+        # base64 encoded instruction images
+        self._feedback_images = feedback_images if feedback_images is not None else feedback.FeedbackImageCache()
+        self._workflow = task_workflow if task_workflow is not None else get_default_workflow()
+        # how many consecutive frames an object has appeared, indexed by label. All labels are counted, whatever the
+        # state, and the counters carry over state changes.
+        self._cumulative_object_counters = np.zeros(len(self._workflow.labels), dtype=np.int64)
+        self.current_state = None
+        self._enter_state(self._workflow.initial_state)
+
+    def _enter_state(self, state):
+        self.current_state = state
+        self._state_entry_time = time.time()
+
+    def is_transition_close(self):
+        """Whether the objects the current state waits for were seen in the last frame."""
+        state = self._workflow.states[self.current_state]
+        if any(len(rule.predicates) == 0 for rule in state.rules):
+            return True
+        return bool(np.any(self._cumulative_object_counters[state.label_indices] > 0))
 
     def _check_lever_at_bottom_left_of_tray(self, objects):
         tray = util.get_sorted_objects_by_category(objects, 'tray')[0]
@@ -104,16 +120,34 @@ class Task(object):
         logger.debug("tray is vertical? {}".format(is_vertical))
         return is_vertical
 
-    @staticmethod
-    def _set_instruction(result, speech, image_name, video_name):
+    def _set_instruction(self, result, speech, image_name, video_name):
         result['speech'] = speech
-        image_path = os.path.join(config.IMAGE_PATH_PREFIX, image_name)
         if config.IMAGE_GUIDANCE:
-            result['image'] = cv2.imread(image_path) if image_path else None
-        if config.VIDEO_GUIDANCE:
+            result['image'] = self._feedback_images.get(image_name) if image_name else None
+        if config.VIDEO_GUIDANCE and video_name:
             result['video'] = config.VIDEO_SERVER_URL + '/' + video_name
 
-    # TODO: The state machine can be constructed using a builder pattern
+    def _evaluate(self, predicate, objects, object_counts):
+        if isinstance(predicate, workflow.Consecutive):
+            return self._cumulative_object_counters[predicate.label_idx] == predicate.frames
+        if isinstance(predicate, workflow.Count):
+            return any(object_counts[label_idx] == predicate.count for label_idx in predicate.label_indices)
+        if isinstance(predicate, workflow.Check):
+            return GEOMETRY_CHECKS[predicate.name](self, objects)
+        if isinstance(predicate, workflow.Confidence):
+            label_objects = util.get_sorted_objects_by_category(objects, predicate.label)
+            return len(label_objects) > 0 and label_objects[0][-2] > predicate.above
+        raise ValueError('Unknown predicate {}'.format(predicate))
+
+    def _rule_matches(self, rule, objects, object_counts, evaluated):
+        for predicate in rule.predicates:
+            # rules of a state often share predicates. Evaluate each one at most once per frame.
+            if predicate not in evaluated:
+                evaluated[predicate] = self._evaluate(predicate, objects, object_counts)
+            if not evaluated[predicate]:
+                return False
+        return True
+
     def get_instruction(self, objects):
         """
         Task Model. Return instructions for the next state
@@ -126,103 +160,72 @@ class Task(object):
         # sensor control
         control = {}
 
-        # restart the demo after the last run is finished for a while
-        if self.current_state == 'finished' and (time.time() - self._last_run_finish_time >
-                                                 self._minimal_seconds_between_runs):
-            self.current_state = "start"
-
-        # the start
-        if self.current_state == "start":
-            self._set_instruction(result, "Put the tray on the table.", "tray.jpg", "tray.mp4")
-            self.current_state = "nothing"
-            return result, control
-
-        # when no object is detected
-        if len(objects) == 0:
-            self._cumulative_object_counters.clear()
-            return result, control
-
-        # there are some interesting objects in the frame
-        current_object_counts = {}
-        for idx, object_name in enumerate(config.LABELS):
-            object_cnt = sum(objects[:, -1] == idx)
-            current_object_counts[object_name] = object_cnt
-
-        # update the cumulative counter as well
-        for object_name in config.LABELS:
-            if current_object_counts[object_name] > 0:
-                self._cumulative_object_counters[object_name] += 1
-            else:
-                self._cumulative_object_counters[object_name] = 0
-
-        if self.current_state == "nothing":
-            if self._cumulative_object_counters['tray'] == 3:
-                self._set_instruction(result, "Good job. Now show me the lever", "lever.jpg",
-                                      "lever.mp4")
-                self.current_state = "lever"
-        elif self.current_state == "lever":
-            if self._cumulative_object_counters['lever'] == 3:
-                self._set_instruction(result, "Good. Now assemble the lever onto tray. Show me the vertical view.",
-                                      "dangling.jpg",
-                                      "dangling.mp4")
-                self.current_state = "dangling"
-        elif self.current_state == "dangling":
-            if current_object_counts['tray'] == 1 and self._check_tray_vertical(objects):
-                if current_object_counts['lever'] == 1 or current_object_counts['leverside'] == 1:
-                    if self._check_lever_at_bottom_left_of_tray(objects):
-                        if self._check_dangling(objects):
-                            self._set_instruction(result,
-                                                  "Great. Insert the guide to the side of the tray. Place the tray on "
-                                                  "the table horizontally when done.",
-                                                  "guide.jpg",
-                                                  "guide.mp4")
-                            self.current_state = "guide"
-                        else:
-                            self._set_instruction(result, "The lever is misplaced. Please make sure it is secure.",
-                                                  "dangling.jpg", "dangling.mp4")
-        elif self.current_state == "guide":
-            if self._cumulative_object_counters['tray'] == 10:
-                if self._check_tray_horizontal(objects):
-                    self._set_instruction(result,
-                                          "Okay. Find the cap and show me the side view with pin holding up",
-                                          "cap.jpg",
-                                          "cap.mp4")
-                    self.current_state = "cap"
-        elif self.current_state == "cap":
-            if current_object_counts['arc'] == 1 and current_object_counts['pin'] == 1:
-                self._set_instruction(result, "Excellent. Now assemble the cap onto the tray. Start from left to "
-                                              "right. Show "
-                                              "me a vertical view when done", "assembled.jpg",
-                                      "assembled.mp4")
-                self.current_state = "assembled"
-        elif self.current_state == "assembled":
-            if current_object_counts['assembled'] == 1:
-                self._set_instruction(result, "Awesome. Show me a close-up view to see if the pin is at right place.",
-                                      "pin.jpg",
-                                      "pin.mp4"
-                                      )
-                self.current_state = "pin"
-                # The pin is very small. Flashlight needs to be turned on for reliable detection
-                control[gabriel.Protocol_control.JSON_KEY_FLASHLIGHT] = True
-        elif self.current_state == "pin":
-            if self._cumulative_object_counters['pin'] == 2:
-                self._set_instruction(result, "Please place the pin into the slot.", "pin.jpg",
-                                      "pin.mp4")
-            elif self._cumulative_object_counters['slotpin'] == 2:
-                self._set_instruction(result, "Fabulous. Now close the lever.",
-                                      "clamped.jpg", "clamped.mp4")
-                self.current_state = "clamped"
-                control[gabriel.Protocol_control.JSON_KEY_FLASHLIGHT] = False
-        elif self.current_state == "clamped":
-            clamped_objects = util.get_sorted_objects_by_category(objects, 'clamped')
-            if len(clamped_objects) > 0 and clamped_objects[0][-2] > 0.9:
-                self._set_instruction(result, "Finished! Congratulations!", "finshed.jpg",
-                                      "finished.mp4")
-                self.current_state = "finished"
-                self._last_run_finish_time = time.time()
+        state = self._workflow.states[self.current_state]
+        if state.restart_after is not None and time.time() - self._state_entry_time > state.restart_after:
+            self._enter_state(self._workflow.initial_state)
+            state = self._workflow.states[self.current_state]
+
+        if state.rules and all(len(rule.predicates) == 0 for rule in state.rules):
+            # a state that only gives unconditional instructions, like the start, does not look at the frame
+            rules = state.rules
+            object_counts = None
+        elif len(objects) == 0:
+            # when no object is detected, only unconditional rules can apply
+            self._cumulative_object_counters[:] = 0
+            rules = [rule for rule in state.rules if len(rule.predicates) == 0]
+            object_counts = None
+        else:
+            rules = state.rules
+            object_counts = np.bincount(objects[:, -1].astype(np.intp),
+                                        minlength=len(self._workflow.labels))[:len(self._workflow.labels)]
+            # update the cumulative counter as well
+            self._cumulative_object_counters = np.where(object_counts > 0, self._cumulative_object_counters + 1, 0)
+
+        evaluated = {}
+        for rule in rules:
+            if self._rule_matches(rule, objects, object_counts, evaluated):
+                self._set_instruction(result, rule.speech, rule.image, rule.video)
+                control.update(rule.control)
+                if rule.next_state is not None:
+                    self._enter_state(rule.next_state)
+                break
 
         if not config.VIDEO_GUIDANCE:
             if 'video' in result:
                 del result['video']
 
         return result, control
+
+
+# geometry checks that workflows can refer to by name
+GEOMETRY_CHECKS = {
+    'lever_at_bottom_left_of_tray': Task._check_lever_at_bottom_left_of_tray,
+    'dangling': Task._check_dangling,
+    'tray_horizontal': Task._check_tray_horizontal,
+    'tray_vertical': Task._check_tray_vertical,
+}
+
+# sensor controls that workflows can refer to by name: the gabriel.Protocol_control attribute holding the key, and the
+# key to use with gabriel versions that do not define it
+CONTROLS = {
+    'flashlight': ('JSON_KEY_FLASHLIGHT', 'flashlight'),
+}
+
+_default_workflow = None
+
+
+def control_keys():
+    """The sensor control keys of CONTROLS in the installed gabriel."""
+    return dict((name, getattr(gabriel.Protocol_control, attribute, default))
+                for name, (attribute, default) in CONTROLS.items())
+
+
+def get_default_workflow():
+    """The workflow from config.WORKFLOW_PATH, or the built-in DiskTray workflow. Compiled once per process."""
+    global _default_workflow
+    if _default_workflow is None:
+        definition = workflow.DISKTRAY_WORKFLOW
+        if config.WORKFLOW_PATH:
+            definition = workflow.load_workflow(config.WORKFLOW_PATH)
+        _default_workflow = workflow.compile_workflow(definition, config.LABELS, GEOMETRY_CHECKS, control_keys())
+    return _default_workflow
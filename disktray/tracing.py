@@ -0,0 +1,154 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Per-frame latency tracing.
+
+Each frame gets a FrameTrace when it is received, which collects how long the frame spent in every processing stage.
+Finished traces are added to a Tracer, which keeps a histogram per stage and reports p50/p95/p99 latencies on demand,
+e.g. when the process receives SIGUSR1.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import itertools
+import signal
+import threading
+import time
+
+import numpy as np
+from logzero import logger
+
+PERCENTILES = (50, 95, 99)
+
+
+class FrameTrace(object):
+    """Stage durations of one frame, in seconds."""
+
+    def __init__(self, frame_id=None):
+        self.frame_id = frame_id
+        self.received_time = time.time()
+        self.durations = collections.OrderedDict()
+        self._timestamps = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start_time)
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0) + seconds
+
+    def stamp(self, name):
+        """Remember the current time, for stages that start and end in different places."""
+        self._timestamps[name] = time.time()
+
+    def since(self, name):
+        return time.time() - self._timestamps[name]
+
+    def elapsed(self):
+        return time.time() - self.received_time
+
+
+class Histogram(object):
+    """Sliding window of the most recent samples of a measurement."""
+
+    def __init__(self, window):
+        self._samples = np.zeros(window)
+        self.count = 0
+
+    def add(self, value):
+        self._samples[self.count % len(self._samples)] = value
+        self.count += 1
+
+    def percentiles(self, percentiles=PERCENTILES):
+        num_samples = min(self.count, len(self._samples))
+        if num_samples == 0:
+            return [float('nan')] * len(percentiles)
+        return np.percentile(self._samples[:num_samples], percentiles)
+
+
+class Tracer(object):
+    """Latency histograms of the stages of all frames seen by a process, and counters of events such as dropped
+    frames."""
+
+    def __init__(self, name, window=10000):
+        self.name = name
+        self._window = window
+        self._histograms = collections.OrderedDict()
+        self._counters = collections.OrderedDict()
+        self._frame_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def new_frame(self):
+        return FrameTrace(next(self._frame_ids))
+
+    def record(self, stage, seconds):
+        with self._lock:
+            if stage not in self._histograms:
+                self._histograms[stage] = Histogram(self._window)
+            self._histograms[stage].add(seconds)
+
+    def count(self, event, n=1):
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + n
+
+    def counters(self):
+        with self._lock:
+            return collections.OrderedDict(self._counters)
+
+    def record_durations(self, durations):
+        for stage, seconds in durations.items():
+            self.record(stage, seconds)
+
+    def finish(self, trace):
+        """Add the stage durations of a frame, and its total time since it was received."""
+        self.record_durations(trace.durations)
+        total = trace.elapsed()
+        self.record('total', total)
+        logger.debug('{} frame {}: total {:.1f} ms, {}'.format(
+            self.name, trace.frame_id, total * 1000,
+            ', '.join('{} {:.1f} ms'.format(stage, seconds * 1000) for stage, seconds in trace.durations.items())))
+
+    def summary(self):
+        """:return: {stage: (number of samples, p50 ms, p95 ms, p99 ms)}"""
+        with self._lock:
+            return collections.OrderedDict(
+                (stage, (histogram.count,) + tuple(p * 1000 for p in histogram.percentiles()))
+                for stage, histogram in self._histograms.items())
+
+    def format_summary(self):
+        lines = ['{} latency (ms)    count      p50      p95      p99'.format(self.name)]
+        for stage, (count, p50, p95, p99) in self.summary().items():
+            lines.append('{:>20} {:>8d} {:>8.1f} {:>8.1f} {:>8.1f}'.format(stage, count, p50, p95, p99))
+        for event, count in self.counters().items():
+            lines.append('{:>20} {:>8d}'.format(event, count))
+        return '\n'.join(lines)
+
+    def log_summary(self):
+        logger.info(self.format_summary())
+
+
+def install_signal_handler(tracer, signum=signal.SIGUSR1):
+    """Log the latency percentiles of tracer whenever the process receives signum."""
+
+    def summary_signal_handler(signal, frame):
+        tracer.log_summary()
+
+    signal.signal(signum, summary_signal_handler)
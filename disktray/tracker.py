@@ -0,0 +1,149 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""IoU based object tracking, to feed the task state machine on frames that are not run through the detector."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from disktray import config
+
+
+def box_iou(boxes_a, boxes_b):
+    """Pairwise intersection over union of two sets of [x1, y1, x2, y2] boxes.
+
+    :return: (len(boxes_a), len(boxes_b)) array
+    """
+    boxes_a = boxes_a[:, np.newaxis, :4]
+    boxes_b = boxes_b[np.newaxis, :, :4]
+    inter_w = np.maximum(0, np.minimum(boxes_a[..., 2], boxes_b[..., 2]) - np.maximum(boxes_a[..., 0], boxes_b[..., 0]))
+    inter_h = np.maximum(0, np.minimum(boxes_a[..., 3], boxes_b[..., 3]) - np.maximum(boxes_a[..., 1], boxes_b[..., 1]))
+    inter = inter_w * inter_h
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+    return inter / np.maximum(area_a + area_b - inter, 1e-6)
+
+
+class IouTracker(object):
+    """Tracks detections across frames by class and IoU, with a constant velocity motion model.
+
+    The detector runs on one frame out of detect_every_n_frames. On the frames in between, predict() moves every track
+    along its velocity and returns the predicted boxes, in the same [x1, y1, x2, y2, confidence, cls_idx] format as
+    the detector. A detected frame is the truth: tracks that none of its detections match are dropped, so that objects
+    the detector no longer sees are not predicted. Tracks are also dropped after max_predicted_frames frames without a
+    detection.
+    """
+
+    def __init__(self, detect_every_n_frames=config.DETECT_EVERY_N_FRAMES,
+                 iou_threshold=config.TRACKER_IOU_THRESHOLD,
+                 max_predicted_frames=config.TRACKER_MAX_PREDICTED_FRAMES, velocity_smoothing=0.5):
+        self._detect_every_n_frames = max(1, detect_every_n_frames)
+        self._iou_threshold = iou_threshold
+        self._max_predicted_frames = max_predicted_frames
+        self._velocity_smoothing = velocity_smoothing
+        self._frames_since_scheduled_detection = 0
+
+        # one row per track
+        self._objects = np.zeros((0, 6), dtype=np.float32)
+        self._last_detected_boxes = np.zeros((0, 4), dtype=np.float32)
+        self._velocities = np.zeros((0, 4), dtype=np.float32)
+        self._frames_since_detection = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._objects)
+
+    def should_detect(self, sampled=None):
+        """Whether the next frame should go through the detector. Called once per frame, when it is received.
+
+        :param sampled: whether the sampling policy picked the frame, None without a sampling policy. While there are
+            tracks, a detection is forced every detect_every_n_frames frames so that they do not expire, whatever the
+            sampling policy says. Without a sampling policy, every frame is detected while there are no tracks.
+        """
+        self._frames_since_scheduled_detection += 1
+        has_tracks = len(self._objects) > 0
+        if sampled is None:
+            sampled = not has_tracks
+        if sampled or (has_tracks and self._frames_since_scheduled_detection >= self._detect_every_n_frames):
+            self._frames_since_scheduled_detection = 0
+            return True
+        return False
+
+    def predict(self):
+        """Advance the tracks by one frame without a detection.
+
+        :return: predicted objects, [[x1, y1, x2, y2, confidence, cls_idx]]
+        """
+        self._frames_since_detection += 1
+        self._objects[:, :4] += self._velocities
+        self._keep(self._frames_since_detection <= self._max_predicted_frames)
+        return self._objects.copy()
+
+    def update(self, detections):
+        """Associate the detections of a frame with the tracks. Tracks without a detection are dropped."""
+        detections = np.asarray(detections, dtype=np.float32).reshape(-1, 6)
+        self._frames_since_detection += 1
+        matched_tracks, matched_detections = self._associate(detections)
+
+        # velocity in pixels per frame since the track was last detected, smoothed over detections
+        elapsed = self._frames_since_detection[matched_tracks][:, np.newaxis]
+        velocities = (detections[matched_detections, :4] - self._last_detected_boxes[matched_tracks]) / elapsed
+        self._velocities[matched_tracks] = (self._velocity_smoothing * velocities +
+                                            (1 - self._velocity_smoothing) * self._velocities[matched_tracks])
+        self._objects[matched_tracks] = detections[matched_detections]
+        self._last_detected_boxes[matched_tracks] = detections[matched_detections, :4]
+        self._frames_since_detection[matched_tracks] = 0
+
+        unmatched = np.ones(len(detections), dtype=bool)
+        unmatched[matched_detections] = False
+        matched = np.zeros(len(self._objects), dtype=bool)
+        matched[matched_tracks] = True
+        self._keep(matched)
+        new_detections = detections[unmatched]
+        self._objects = np.vstack((self._objects, new_detections))
+        self._last_detected_boxes = np.vstack((self._last_detected_boxes, new_detections[:, :4]))
+        self._velocities = np.vstack((self._velocities, np.zeros((len(new_detections), 4), dtype=np.float32)))
+        self._frames_since_detection = np.concatenate((self._frames_since_detection,
+                                                       np.zeros(len(new_detections), dtype=np.int64)))
+
+    def _associate(self, detections):
+        """Greedily match tracks and detections of the same class, by decreasing IoU.
+
+        :return: indices of the matched tracks and of their detections
+        """
+        if len(self._objects) == 0 or len(detections) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        ious = box_iou(self._objects, detections)
+        ious[self._objects[:, np.newaxis, 5] != detections[np.newaxis, :, 5]] = 0
+        track_inds, detection_inds = np.nonzero(ious >= self._iou_threshold)
+        order = np.argsort(-ious[track_inds, detection_inds], kind='mergesort')
+        matched_tracks = []
+        matched_detections = []
+        used_tracks = set()
+        used_detections = set()
+        for track_idx, detection_idx in zip(track_inds[order], detection_inds[order]):
+            if track_idx in used_tracks or detection_idx in used_detections:
+                continue
+            used_tracks.add(track_idx)
+            used_detections.add(detection_idx)
+            matched_tracks.append(track_idx)
+            matched_detections.append(detection_idx)
+        return np.array(matched_tracks, dtype=np.intp), np.array(matched_detections, dtype=np.intp)
+
+    def _keep(self, mask):
+        self._objects = self._objects[mask]
+        self._last_detected_boxes = self._last_detected_boxes[mask]
+        self._velocities = self._velocities[mask]
+        self._frames_since_detection = self._frames_since_detection[mask]
@@ -57,6 +57,20 @@ def get_sorted_objects_by_categories(objects, categories, object_list=config.LAB
     return np.vstack(cats_objs)
 
 
+def build_label_mapping(model_labels, canonical_labels):
+    """Build a lookup array from the class indices of a detector to the indices of canonical_labels.
+
+    :param model_labels: label names in the order the detector outputs them
+    :param canonical_labels: label names in the order used by the task
+    :return: integer numpy array where mapping[model_idx] is the canonical index
+    """
+    if len(set(model_labels)) != len(model_labels):
+        raise ValueError('Duplicate labels in the model labels: {}'.format(model_labels))
+    if set(model_labels) != set(canonical_labels):
+        raise ValueError('Model labels {} do not match the task labels {}'.format(model_labels, canonical_labels))
+    return np.array([canonical_labels.index(label) for label in model_labels], dtype=np.intp)
+
+
 class Timer(contextlib2.ContextDecorator):
 
     def __init__(self, name):
@@ -0,0 +1,197 @@
+# Copyright (C) 2018 Carnegie Mellon University. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Declarative task workflows.
+
+A workflow is plain data, so that it can also be loaded from a YAML file:
+
+    initial_state: start
+    states:
+      - name: nothing
+        rules:
+          - when:
+              - {type: consecutive, label: tray, frames: 3}
+            speech: Good job. Now show me the lever
+            image: lever.jpg
+            video: lever.mp4
+            next: lever
+
+The rules of a state are tried in order and the first one whose predicates all hold gives the instruction, the
+optional sensor control and the next state. Predicates are:
+
+    consecutive: label has been detected in exactly `frames` consecutive frames. Every label is counted on every frame,
+                 whatever the state, and the count carries over state changes
+    count:       exactly `count` objects of one of `labels` are detected in the frame
+    check:       the geometry check `name` of the task passes
+    confidence:  the most confident object of `label` has a confidence above `above`
+
+A state with `restart_after` goes back to the initial state that many seconds after it was entered.
+
+compile_workflow turns a definition into a transition table with label names resolved to indices, so that evaluating
+a frame only checks the predicates of the current state.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+
+import numpy as np
+import yaml
+
+DISKTRAY_WORKFLOW = {
+    'initial_state': 'start',
+    'states': [
+        {'name': 'start', 'rules': [
+            {'when': [],
+             'speech': "Put the tray on the table.", 'image': "tray.jpg", 'video': "tray.mp4",
+             'next': 'nothing'},
+        ]},
+        {'name': 'nothing', 'rules': [
+            {'when': [{'type': 'consecutive', 'label': 'tray', 'frames': 3}],
+             'speech': "Good job. Now show me the lever", 'image': "lever.jpg", 'video': "lever.mp4",
+             'next': 'lever'},
+        ]},
+        {'name': 'lever', 'rules': [
+            {'when': [{'type': 'consecutive', 'label': 'lever', 'frames': 3}],
+             'speech': "Good. Now assemble the lever onto tray. Show me the vertical view.", 'image': "dangling.jpg",
+             'video': "dangling.mp4",
+             'next': 'dangling'},
+        ]},
+        {'name': 'dangling', 'rules': [
+            {'when': [{'type': 'count', 'labels': ['tray'], 'count': 1},
+                      {'type': 'check', 'name': 'tray_vertical'},
+                      {'type': 'count', 'labels': ['lever', 'leverside'], 'count': 1},
+                      {'type': 'check', 'name': 'lever_at_bottom_left_of_tray'},
+                      {'type': 'check', 'name': 'dangling'}],
+             'speech': "Great. Insert the guide to the side of the tray. Place the tray on the table horizontally "
+                       "when done.",
+             'image': "guide.jpg", 'video': "guide.mp4",
+             'next': 'guide'},
+            {'when': [{'type': 'count', 'labels': ['tray'], 'count': 1},
+                      {'type': 'check', 'name': 'tray_vertical'},
+                      {'type': 'count', 'labels': ['lever', 'leverside'], 'count': 1},
+                      {'type': 'check', 'name': 'lever_at_bottom_left_of_tray'}],
+             'speech': "The lever is misplaced. Please make sure it is secure.", 'image': "dangling.jpg",
+             'video': "dangling.mp4"},
+        ]},
+        {'name': 'guide', 'rules': [
+            {'when': [{'type': 'consecutive', 'label': 'tray', 'frames': 10},
+                      {'type': 'check', 'name': 'tray_horizontal'}],
+             'speech': "Okay. Find the cap and show me the side view with pin holding up", 'image': "cap.jpg",
+             'video': "cap.mp4",
+             'next': 'cap'},
+        ]},
+        {'name': 'cap', 'rules': [
+            {'when': [{'type': 'count', 'labels': ['arc'], 'count': 1},
+                      {'type': 'count', 'labels': ['pin'], 'count': 1}],
+             'speech': "Excellent. Now assemble the cap onto the tray. Start from left to right. Show me a vertical "
+                       "view when done",
+             'image': "assembled.jpg", 'video': "assembled.mp4",
+             'next': 'assembled'},
+        ]},
+        {'name': 'assembled', 'rules': [
+            {'when': [{'type': 'count', 'labels': ['assembled'], 'count': 1}],
+             'speech': "Awesome. Show me a close-up view to see if the pin is at right place.", 'image': "pin.jpg",
+             'video': "pin.mp4",
+             # The pin is very small. Flashlight needs to be turned on for reliable detection
+             'control': {'flashlight': True},
+             'next': 'pin'},
+        ]},
+        {'name': 'pin', 'rules': [
+            {'when': [{'type': 'consecutive', 'label': 'pin', 'frames': 2}],
+             'speech': "Please place the pin into the slot.", 'image': "pin.jpg", 'video': "pin.mp4"},
+            {'when': [{'type': 'consecutive', 'label': 'slotpin', 'frames': 2}],
+             'speech': "Fabulous. Now close the lever.", 'image': "clamped.jpg", 'video': "clamped.mp4",
+             'control': {'flashlight': False},
+             'next': 'clamped'},
+        ]},
+        {'name': 'clamped', 'rules': [
+            {'when': [{'type': 'confidence', 'label': 'clamped', 'above': 0.9}],
+             'speech': "Finished! Congratulations!", 'image': "finshed.jpg", 'video': "finished.mp4",
+             'next': 'finished'},
+        ]},
+        # restart the demo after the last run is finished for a while
+        {'name': 'finished', 'restart_after': 20, 'rules': []},
+    ],
+}
+
+# compiled predicates
+Consecutive = collections.namedtuple('Consecutive', ['label_idx', 'frames'])
+Count = collections.namedtuple('Count', ['label_indices', 'count'])
+Check = collections.namedtuple('Check', ['name'])
+Confidence = collections.namedtuple('Confidence', ['label', 'above'])
+
+Rule = collections.namedtuple('Rule', ['predicates', 'speech', 'image', 'video', 'control', 'next_state'])
+State = collections.namedtuple('State', ['name', 'rules', 'label_indices', 'restart_after'])
+Workflow = collections.namedtuple('Workflow', ['initial_state', 'states', 'labels'])
+
+
+def load_workflow(path):
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+def _compile_predicate(predicate, labels, checks):
+    predicate_type = predicate['type']
+    if predicate_type == 'consecutive':
+        return Consecutive(labels.index(predicate['label']), int(predicate['frames']))
+    if predicate_type == 'count':
+        return Count(tuple(labels.index(label) for label in predicate['labels']), int(predicate['count']))
+    if predicate_type == 'check':
+        if predicate['name'] not in checks:
+            raise ValueError('Unknown geometry check {}. Available: {}'.format(predicate['name'], sorted(checks)))
+        return Check(predicate['name'])
+    if predicate_type == 'confidence':
+        labels.index(predicate['label'])
+        return Confidence(predicate['label'], float(predicate['above']))
+    raise ValueError('Unknown predicate type {}'.format(predicate_type))
+
+
+def _predicate_labels(predicate):
+    if isinstance(predicate, Consecutive):
+        return [predicate.label_idx]
+    if isinstance(predicate, Count):
+        return list(predicate.label_indices)
+    return []
+
+
+def compile_workflow(definition, labels, checks, controls):
+    """Compile a workflow definition into a transition table.
+
+    :param labels: canonical label names, whose indices are used in detections
+    :param checks: names of the available geometry checks
+    :param controls: mapping from the control names used in the definition to sensor control keys
+    :return: Workflow whose states map state names to State
+    """
+    state_names = set(state['name'] for state in definition['states'])
+    states = {}
+    for state in definition['states']:
+        rules = []
+        label_indices = set()
+        for rule in state.get('rules', []):
+            predicates = tuple(_compile_predicate(predicate, labels, checks) for predicate in rule.get('when', []))
+            for predicate in predicates:
+                label_indices.update(_predicate_labels(predicate))
+            next_state = rule.get('next')
+            if next_state is not None and next_state not in state_names:
+                raise ValueError('State {} has a transition to unknown state {}'.format(state['name'], next_state))
+            control = dict((controls[name], value) for name, value in rule.get('control', {}).items())
+            rules.append(Rule(predicates, rule.get('speech'), rule.get('image'), rule.get('video'), control,
+                              next_state))
+        states[state['name']] = State(state['name'], tuple(rules), np.array(sorted(label_indices), dtype=np.intp),
+                                      state.get('restart_after'))
+    if definition['initial_state'] not in states:
+        raise ValueError('Unknown initial state {}'.format(definition['initial_state']))
+    return Workflow(definition['initial_state'], states, list(labels))
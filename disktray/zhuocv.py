@@ -21,7 +21,9 @@ import cv2
 import math
 import numpy as np
 import os
+import struct
 import sys
+import tempfile
 import time
 
 current_milli_time = lambda: int(round(time.time() * 1000))
@@ -100,13 +102,78 @@ def shrink(img, size, method = 'square', iterations = 1):
     return cv2.erode(img, kernel, iterations = iterations)
 
 def raw2cv_image(raw_data, gray_scale = False):
-    img_array = np.asarray(bytearray(raw_data), dtype=np.int8)
+    img_array = np.frombuffer(raw_data, dtype=np.uint8)
     if gray_scale:
         cv_image = cv2.imdecode(img_array, 0)
     else:
         cv_image = cv2.imdecode(img_array, -1)
     return cv_image
 
+# start of frame markers, which hold the image size. 0xC4, 0xC8 and 0xCC are other markers in the same range
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+# IMREAD flags of the DCT-scaled decodes, from the largest reduction
+JPEG_REDUCED_DECODES = [(8, getattr(cv2, 'IMREAD_REDUCED_COLOR_8', None)),
+                        (4, getattr(cv2, 'IMREAD_REDUCED_COLOR_4', None)),
+                        (2, getattr(cv2, 'IMREAD_REDUCED_COLOR_2', None))]
+# temporary files for the reduced decodes are written here when possible, to stay in memory
+TEMP_IMAGE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def _imdecode_supports_reduced():
+    '''
+    Some OpenCV versions only honor the IMREAD_REDUCED flags in imread, not in imdecode.
+    '''
+    if JPEG_REDUCED_DECODES[-1][1] is None:
+        return False
+    data = cv2.imencode('.jpg', np.zeros((16, 16, 3), dtype=np.uint8))[1]
+    return cv2.imdecode(data, JPEG_REDUCED_DECODES[-1][1]).shape[0] == 8
+
+IMDECODE_SUPPORTS_REDUCED = _imdecode_supports_reduced()
+
+def jpeg_size(raw_data):
+    '''
+    Read the (height, width) of a JPEG image from its header without decoding it.
+    Returns None if raw_data is not a JPEG image.
+    '''
+    if raw_data[:2] != b'\xff\xd8':
+        return None
+    idx = 2
+    while idx + 9 <= len(raw_data):
+        prefix, marker = struct.unpack_from('BB', raw_data, idx)
+        if prefix != 0xFF:
+            return None
+        if marker == 0xFF: # fill byte
+            idx += 1
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', raw_data, idx + 5)
+            return (height, width)
+        segment_length, = struct.unpack_from('>H', raw_data, idx + 2)
+        idx += 2 + segment_length
+    return None
+
+def raw2cv_image_reduced(raw_data, max_wh):
+    '''
+    Decode a color image at the smallest DCT-scaled size (1/2, 1/4 or 1/8) whose larger side is still at least max_wh,
+    so that only a small resize is left to reach max_wh. Other images are fully decoded.
+    Returns the image and its scale relative to the encoded image.
+    '''
+    size = jpeg_size(raw_data)
+    img_array = np.frombuffer(raw_data, dtype=np.uint8)
+    if size is not None:
+        for factor, flag in JPEG_REDUCED_DECODES:
+            if flag is not None and max(size) >= max_wh * factor:
+                if IMDECODE_SUPPORTS_REDUCED:
+                    cv_image = cv2.imdecode(img_array, flag)
+                else:
+                    with tempfile.NamedTemporaryFile(suffix = '.jpg', dir = TEMP_IMAGE_DIR) as f:
+                        f.write(raw_data)
+                        f.flush()
+                        cv_image = cv2.imread(f.name, flag)
+                if cv_image is not None:
+                    return cv_image, float(cv_image.shape[1]) / size[1]
+                break
+    return cv2.imdecode(img_array, cv2.IMREAD_COLOR), 1.0
+
 def cv_image2raw(img, jpeg_quality = 95):
     result, data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
     raw_data = data.tostring()
@@ -1063,6 +1130,49 @@ def checkBlurByGradient(img, gradientPatchNBox = 5, gradientPatchWidth = 25, gra
     else:
         return True
 
+def gradient_patch_sums(bw, gradientPatchNBox = 5, gradientPatchWidth = 25, gradientPatchHeight = 25, ksize = 5):
+    '''
+    Sum of the absolute mixed derivative (Sobel, dx = dy = 1) of a grayscale image over each patch of a
+    @gradientPatchNBox x @gradientPatchNBox grid of patches spread over the image.
+    The patches are gathered, together with the neighbour pixels the filter needs, into one mosaic that is filtered in a
+    single Sobel pass, so that only the patches are filtered. Pixels beyond the image edge repeat the edge pixel.
+    Returns a @gradientPatchNBox x @gradientPatchNBox array.
+    '''
+    n_rows, n_cols = bw.shape[:2]
+    border = ksize // 2
+    positions = 2 * np.arange(gradientPatchNBox) + 1
+    tops = (n_rows // (2 * gradientPatchNBox + 1)) * positions
+    lefts = (n_cols // (2 * gradientPatchNBox + 1)) * positions
+    rows = np.clip(tops[:, np.newaxis] + np.arange(-border, gradientPatchHeight + border), 0, n_rows - 1)
+    cols = np.clip(lefts[:, np.newaxis] + np.arange(-border, gradientPatchWidth + border), 0, n_cols - 1)
+    mosaic = bw[np.ix_(rows.ravel(), cols.ravel())]
+    gradients = np.absolute(cv2.Sobel(mosaic, cv2.CV_32F, 1, 1, ksize = ksize))
+    gradients = gradients.reshape(gradientPatchNBox, gradientPatchHeight + 2 * border,
+                                  gradientPatchNBox, gradientPatchWidth + 2 * border)
+    patches = gradients[:, border : border + gradientPatchHeight, :, border : border + gradientPatchWidth]
+    return patches.sum(axis = (1, 3))
+
+def frame_quality(img, max_wh = 320, gradientPatchNBox = 5, saturation = 250):
+    '''
+    Measure the sharpness and the overexposure of an image on a grayscale copy shrunk so that its larger side is at most
+    @max_wh.
+    Sharpness is the largest mean of gradient_patch_sums with a 3x3 filter, over a grid of patches of a
+    (2 * @gradientPatchNBox + 1)th of the image on each side.
+    Overexposure is the fraction of pixels at or above @saturation.
+    Returns a tuple of (sharpness, overexposure).
+    '''
+    scale = float(max_wh) / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, (0, 0), fx = scale, fy = scale, interpolation = cv2.INTER_AREA)
+    bw = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    n_rows, n_cols = bw.shape[:2]
+    patch_height = max(1, n_rows // (2 * gradientPatchNBox + 1))
+    patch_width = max(1, n_cols // (2 * gradientPatchNBox + 1))
+    sums = gradient_patch_sums(bw, gradientPatchNBox, patch_width, patch_height, ksize = 3)
+    sharpness = sums.max() / (patch_width * patch_height)
+    overexposure = np.count_nonzero(bw >= saturation) / float(bw.size)
+    return sharpness, overexposure
+
 ########################## OBJECT DETECTION ###################################
 ### http://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
 def non_max_suppression_fast(boxes, overlapThresh):
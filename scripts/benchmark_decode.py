@@ -0,0 +1,67 @@
+#!/usr/bin/env python2
+"""Benchmark of the frame decode and resize of the object server, by input resolution.
+
+Compares a full JPEG decode followed by an INTER_AREA resize to config.IMAGE_MAX_WH with the DCT-scaled reduced decode
+of zhuocv.raw2cv_image_reduced followed by the remaining resize, on synthetic frames.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from disktray import zhuocv as zc
+
+RESOLUTIONS = ((480, 640), (720, 1280), (1080, 1920), (1440, 2560), (2160, 3840))
+
+
+def synthetic_jpeg(height, width, quality):
+    """A smooth gradient with some noise, closer to camera frames than pure noise."""
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.dstack(((x * 255 // width), (y * 255 // height), ((x + y) * 255 // (width + height)))).astype(np.uint8)
+    noise = np.random.RandomState(0).randint(0, 16, size=img.shape).astype(np.uint8)
+    return cv2.imencode('.jpg', img + noise, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tostring()
+
+
+def resize(img, max_wh):
+    if max(img.shape) > max_wh:
+        resize_ratio = float(max_wh) / max(img.shape[0], img.shape[1])
+        img = cv2.resize(img, (0, 0), fx=resize_ratio, fy=resize_ratio, interpolation=cv2.INTER_AREA)
+    return img
+
+
+def full_decode(data, max_wh):
+    return resize(zc.raw2cv_image(data), max_wh)
+
+
+def reduced_decode(data, max_wh):
+    return resize(zc.raw2cv_image_reduced(data, max_wh)[0], max_wh)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--max-wh', type=int, default=640, help='target size, config.IMAGE_MAX_WH')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the synthetic frames')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    print('{:>12} {:>14} {:>14} {:>10}'.format('resolution', 'full (ms)', 'reduced (ms)', 'speedup'))
+    for height, width in RESOLUTIONS:
+        data = synthetic_jpeg(height, width, args.quality)
+        assert full_decode(data, args.max_wh).shape == reduced_decode(data, args.max_wh).shape
+        full_ms = min(timeit.repeat(lambda: full_decode(data, args.max_wh), number=1, repeat=args.repeat)) * 1000
+        reduced_ms = min(timeit.repeat(lambda: reduced_decode(data, args.max_wh), number=1,
+                                       repeat=args.repeat)) * 1000
+        print('{:>12} {:>14.2f} {:>14.2f} {:>9.1f}x'.format('{}x{}'.format(width, height), full_ms, reduced_ms,
+                                                           full_ms / reduced_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python2
+"""Compare the detector backends of disktray.detector on the frames of a recording.
+
+Every backend runs on the same decoded and resized frames. Reports the per-frame latency percentiles of each backend,
+and how many of the detections of the first backend are found by the others (same class, IoU above --iou).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from disktray import detector
+from disktray import replay
+from disktray import tracing
+from disktray import tracker
+from disktray import zhuocv as zc
+
+
+def match_ratio(reference, detections, iou_threshold):
+    """Fraction of the reference detections that have a detection of the same class with IoU above iou_threshold."""
+    if len(reference) == 0:
+        return 1.0
+    if len(detections) == 0:
+        return 0.0
+    ious = tracker.box_iou(reference, detections)
+    ious[reference[:, np.newaxis, 5] != detections[np.newaxis, :, 5]] = 0
+    return np.mean(ious.max(axis=1) >= iou_threshold)
+
+
+def run_backend(backend, frames, repeat):
+    object_detector = detector.create_detector(backend)
+    tracer = tracing.Tracer(backend)
+    results = []
+    for _ in range(repeat):
+        results = []
+        for img, resize_ratio in frames:
+            trace = tracer.new_frame()
+            results.append(object_detector.detect(img, resize_ratio, trace))
+            tracer.finish(trace)
+    return results, tracer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('recording', help='directory recorded with DISKTRAY_RECORD_PATH')
+    parser.add_argument('--backends', default='caffe,opencv', help='comma separated detector backends')
+    parser.add_argument('--max-frames', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--iou', type=float, default=0.5)
+    args = parser.parse_args()
+
+    frame_log = replay.FrameLog(args.recording)
+    frames = [detector.resize_image(zc.raw2cv_image(frame))
+              for _, frame, _ in (frame_log[idx] for idx in range(min(len(frame_log), args.max_frames)))]
+    frame_log.close()
+    print('{} frames'.format(len(frames)))
+
+    reference = None
+    for backend in args.backends.split(','):
+        try:
+            results, tracer = run_backend(backend, frames, args.repeat)
+        except (ImportError, IOError, ValueError, cv2.error) as e:
+            print('{}: not available ({})'.format(backend, e))
+            continue
+        print(tracer.format_summary())
+        n_detections = sum(len(result) for result in results)
+        if reference is None:
+            reference = (backend, results)
+            print('{}: {} detections'.format(backend, n_detections))
+        else:
+            ratio = np.mean([match_ratio(ref, result, args.iou) for ref, result in zip(reference[1], results)])
+            print('{}: {} detections, {:.1%} of the {} detections matched'.format(backend, n_detections, ratio,
+                                                                                 reference[0]))
+
+
+if __name__ == '__main__':
+    main()
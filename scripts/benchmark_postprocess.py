@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+"""Micro-benchmark of the detection post-processing in disktray.postprocess.
+
+Compares filter_detections with the per-class loop caffedetect.detect_object used before, on synthetic im_detect
+outputs. Both use the numpy NMS so that the benchmark runs without py-faster-rcnn.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from disktray import postprocess
+
+
+def per_class_loop(scores, boxes, confidence_threshold, nms_threshold, nms=postprocess.py_nms):
+    """The post-processing loop formerly in caffedetect.detect_object."""
+    result = None
+    for cls_idx in range(scores.shape[1] - 1):
+        cls_idx += 1  # because we skipped background
+        cls_boxes = boxes[:, 4 * cls_idx: 4 * (cls_idx + 1)]
+        cls_scores = scores[:, cls_idx]
+        dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])).astype(np.float32)
+        keep = nms(dets, nms_threshold)
+        dets = dets[keep, :]
+        inds = np.where(dets[:, -1] >= confidence_threshold)[0]
+        dets = dets[inds, :]
+        dets = np.hstack((dets, np.ones((dets.shape[0], 1)) * (cls_idx - 1)))
+        if result is None:
+            result = dets
+        else:
+            result = np.vstack((result, dets))
+    return result
+
+
+def synthetic_im_detect(num_proposals, num_classes, width=640, height=480, seed=0):
+    """Scores and boxes shaped like the output of im_detect, with a few confident clusters per class."""
+    rng = np.random.RandomState(seed)
+    logits = rng.randn(num_proposals, num_classes + 1) * 3
+    scores = np.exp(logits)
+    scores /= scores.sum(axis=1, keepdims=True)
+    x1 = rng.uniform(0, width - 50, (num_proposals, num_classes + 1))
+    y1 = rng.uniform(0, height - 50, (num_proposals, num_classes + 1))
+    w = rng.uniform(20, 200, (num_proposals, num_classes + 1))
+    h = rng.uniform(20, 200, (num_proposals, num_classes + 1))
+    boxes = np.stack((x1, y1, np.minimum(x1 + w, width - 1), np.minimum(y1 + h, height - 1)), axis=2)
+    return scores.astype(np.float32), boxes.reshape(num_proposals, -1).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--proposals', type=int, default=300, help='number of proposals per frame')
+    parser.add_argument('--labels', default='model/labels.txt',
+                        help='labels file used to get the number of classes, if it exists')
+    parser.add_argument('--num-classes', type=int, default=8, help='number of classes when there is no labels file')
+    parser.add_argument('--confidence-threshold', type=float, default=0.7)
+    parser.add_argument('--nms-threshold', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=200, help='number of frames to time')
+    args = parser.parse_args()
+
+    num_classes = args.num_classes
+    if os.path.exists(args.labels):
+        with open(args.labels) as f:
+            num_classes = len(f.read().splitlines())
+    scores, boxes = synthetic_im_detect(args.proposals, num_classes)
+
+    expected = per_class_loop(scores, boxes, args.confidence_threshold, args.nms_threshold)
+    actual = postprocess.filter_detections(scores, boxes, args.confidence_threshold, args.nms_threshold)
+    assert np.allclose(expected, actual), 'filter_detections differs from the per-class loop'
+
+    print('{} proposals, {} classes, {} detections per frame'.format(args.proposals, num_classes, len(actual)))
+    for name, func in [('per-class loop', per_class_loop), ('filter_detections', postprocess.filter_detections)]:
+        seconds = min(timeit.repeat(lambda: func(scores, boxes, args.confidence_threshold, args.nms_threshold),
+                                    number=args.repeat, repeat=3))
+        print('{:>20}: {:.3f} ms/frame'.format(name, seconds / args.repeat * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python2
+"""Benchmark of the frame quality gate of the object server.
+
+Measures the cost per frame of zhuocv.frame_quality, the measure of the gate, against the same measure computed with one
+Sobel pass over the whole grayscale copy, on a synthetic scene and blurred or overexposed copies of it, as decoded by the
+object server. With --recording, also reports the sharpness and overexposure of the frames of a recording and how many
+of them the gate would reject with the configured thresholds.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from disktray import config
+from disktray import detector
+from disktray import protocol
+from disktray import replay
+from disktray import zhuocv as zc
+
+
+def full_pass_sharpness(img, max_wh, n_box=5):
+    """The sharpness of zhuocv.frame_quality, from one Sobel pass over the whole grayscale copy."""
+    scale = max_wh / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    bw = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    grid = 2 * n_box + 1
+    patch_height, patch_width = max(1, bw.shape[0] // grid), max(1, bw.shape[1] // grid)
+    gradients = np.absolute(cv2.Sobel(bw, cv2.CV_32F, 1, 1, ksize=3))
+    cells = gradients[:patch_height * grid, :patch_width * grid].reshape(grid, patch_height, grid, patch_width)
+    return cells[1::2, :, 1::2, :].sum(axis=(1, 3)).max() / (patch_width * patch_height)
+
+
+def synthetic_scene(height, width):
+    """Random shapes and text on a flat background with some noise."""
+    random_state = np.random.RandomState(0)
+    img = np.full((height, width, 3), 90, dtype=np.uint8)
+    for _ in range(150):
+        color = tuple(int(value) for value in random_state.randint(0, 256, 3))
+        x, y = random_state.randint(0, width), random_state.randint(0, height)
+        if random_state.rand() < 0.5:
+            size = (random_state.randint(10, width // 6), random_state.randint(10, height // 4))
+            cv2.rectangle(img, (x, y), (x + size[0], y + size[1]), color, -1)
+        else:
+            cv2.circle(img, (x, y), random_state.randint(5, height // 8), color, -1)
+        cv2.putText(img, 'pin', (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
+    return cv2.add(img, random_state.randint(0, 8, size=img.shape).astype(np.uint8))
+
+
+def variants(img):
+    motion_kernel = np.full((1, 25), 1 / 25.0, dtype=np.float32)
+    return [
+        ('sharp', img),
+        ('gaussian blur 1.5', cv2.GaussianBlur(img, (0, 0), 1.5)),
+        ('gaussian blur 3', cv2.GaussianBlur(img, (0, 0), 3)),
+        ('motion blur 25 px', cv2.filter2D(img, -1, motion_kernel)),
+        ('overexposed', cv2.convertScaleAbs(img, alpha=2.5, beta=60)),
+    ]
+
+
+def time_ms(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+
+
+def report_recording(path, max_wh):
+    frame_log = replay.FrameLog(path)
+    measures = []
+    for _, frame, _ in frame_log:
+        _, frame = protocol.unpack_region(frame)
+        img, _ = detector.resize_image(zc.raw2cv_image_reduced(frame, config.IMAGE_MAX_WH)[0])
+        measures.append(zc.frame_quality(img, max_wh))
+    frame_log.close()
+    if not measures:
+        return
+    sharpness, overexposure = np.array(measures).T
+    print('{} frames of {}'.format(len(measures), path))
+    for name, values in (('sharpness', sharpness), ('overexposure', overexposure)):
+        print('{:>14}: p5 {:.3f}, p50 {:.3f}, p95 {:.3f}'.format(name, *np.percentile(values, (5, 50, 95))))
+    blurry = sharpness < config.QUALITY_GATE_MIN_SHARPNESS
+    overexposed = overexposure > config.QUALITY_GATE_MAX_OVEREXPOSED
+    print('rejected: {:.1%} blurry (sharpness < {}), {:.1%} overexposed (> {:.0%} saturated)'.format(
+        np.mean(blurry & ~overexposed), config.QUALITY_GATE_MIN_SHARPNESS, np.mean(overexposed),
+        config.QUALITY_GATE_MAX_OVEREXPOSED))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recording', help='directory recorded with DISKTRAY_RECORD_PATH')
+    parser.add_argument('--max-wh', type=int, default=config.QUALITY_GATE_MAX_WH,
+                        help='size of the grayscale copy measured by the gate')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    img, _ = detector.resize_image(synthetic_scene(1080, 1920))
+    print('{}x{} frames, as decoded by the object server'.format(img.shape[1], img.shape[0]))
+    print('{:>18} {:>10} {:>12} {:>10} {:>15}'.format('frame', 'sharpness', 'overexposure', 'gate (ms)',
+                                                       'full pass (ms)'))
+    for name, variant in variants(img):
+        sharpness, overexposure = zc.frame_quality(variant, args.max_wh)
+        print('{:>18} {:>10.2f} {:>12.1%} {:>10.2f} {:>15.2f}'.format(
+            name, sharpness, overexposure,
+            time_ms(lambda: zc.frame_quality(variant, args.max_wh), args.repeat),
+            time_ms(lambda: full_pass_sharpness(variant, args.max_wh), args.repeat)))
+
+    if args.recording:
+        report_recording(args.recording, args.max_wh)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python2
+"""Estimate how many frames of a recording the near-duplicate frame cache of the object server would answer.
+
+The frames are decoded and resized like in the object server and replayed through disktray.framecache at their
+recorded times, for every --max-distance given. Reports the hit rate and how many of the hits get a cached result whose
+detections do not match the recorded detections of the frame (same class, IoU above --iou).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from disktray import config
+from disktray import detector
+from disktray import framecache
+from disktray import protocol
+from disktray import replay
+from disktray import tracker
+from disktray import zhuocv as zc
+
+
+def same_detections(cached, detections, iou_threshold):
+    """Whether every detection has a detection of the same class with IoU above iou_threshold in the other result."""
+    if len(cached) != len(detections):
+        return False
+    if len(cached) == 0:
+        return True
+    ious = tracker.box_iou(cached, detections)
+    ious[cached[:, np.newaxis, 5] != detections[np.newaxis, :, 5]] = 0
+    return bool(np.all(ious.max(axis=1) >= iou_threshold) and np.all(ious.max(axis=0) >= iou_threshold))
+
+
+def simulate(frames, max_distance, ttl, iou_threshold):
+    """:return: (hits, hits with different detections)"""
+    hits = mismatches = 0
+    entry = None
+    for timestamp, signature, detections in frames:
+        if (entry is not None and timestamp - entry.timestamp <= ttl
+                and framecache.matches(entry, signature, max_distance)):
+            hits += 1
+            if not same_detections(entry.detections, detections, iou_threshold):
+                mismatches += 1
+            continue
+        entry = framecache.CacheEntry(signature, detections, 0, timestamp)
+    return hits, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', help='directory recorded with DISKTRAY_RECORD_PATH')
+    parser.add_argument('--max-distance', default='1,2,3,5,8',
+                        help='comma separated signature distances, in gray levels')
+    parser.add_argument('--ttl', type=float, default=config.FRAME_CACHE_TTL_MS, help='cache TTL in milliseconds')
+    parser.add_argument('--iou', type=float, default=0.5)
+    args = parser.parse_args()
+
+    frame_log = replay.FrameLog(args.recording)
+    frames = []
+    for timestamp, frame, detections in frame_log:
+        if protocol.is_dropped(detections):
+            continue
+        img, _ = zc.raw2cv_image_reduced(frame, config.IMAGE_MAX_WH)
+        img, _ = detector.resize_image(img)
+        frames.append((timestamp, framecache.frame_signature(img), protocol.decode_detections(detections)))
+    frame_log.close()
+    if not frames:
+        sys.exit('{} has no detected frames'.format(args.recording))
+    print('{} frames, TTL {:.0f} ms'.format(len(frames), args.ttl))
+
+    print('max distance     hits  mismatched')
+    for max_distance in (float(distance) for distance in args.max_distance.split(',')):
+        hits, mismatches = simulate(frames, max_distance, args.ttl / 1000, args.iou)
+        print('{:>12.1f} {:>8.1%} {:>11.1%}'.format(max_distance, hits / len(frames), mismatches / max(hits, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+"""Replay a recording made with DISKTRAY_RECORD_PATH, to benchmark the proxy or the object server offline.
+
+In 'proxy' mode, the frames are fed to a DiskTrayApp connected to a stand-in object server that answers with the
+recorded detection results, so neither a Gabriel control server nor py-faster-rcnn is needed. In 'server' mode, the
+frames are sent to a running object server. Frames are sent as fast as possible, or at the recorded frame rate with
+--realtime. Reports frames/s and the latency percentiles of every stage.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import Queue
+import argparse
+import functools
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from disktray import config
+from disktray import objectclient
+from disktray import replay
+from disktray import tracing
+
+
+def paced(frame_log, realtime):
+    """Yield the frames of the recording, at the recorded frame rate if realtime."""
+    start_time = time.time()
+    first_timestamp = None
+    for timestamp, frame, _ in frame_log:
+        if realtime:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) - (time.time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+        yield frame
+
+
+def replay_to_proxy(frame_log, args):
+    from disktray import app
+
+    server = replay.RecordedDetectionServer(frame_log, ('127.0.0.1', 0), detection_delay=args.detection_delay / 1000)
+    server.start()
+    image_queue = Queue.Queue(args.queue_size)
+    result_queue = Queue.Queue()
+    app_proxy = app.DiskTrayApp(image_queue, result_queue, [server.server_addr], engine_id="DiskTrayReplay",
+                                max_in_flight=args.max_in_flight)
+    app_proxy.start()
+
+    start_time = time.time()
+    for frame_idx, frame in enumerate(paced(frame_log, args.realtime)):
+        image_queue.put(({'frame_id': frame_idx}, frame))
+    for _ in xrange(len(frame_log)):
+        result_queue.get(timeout=args.timeout)
+    elapsed = time.time() - start_time
+
+    app_proxy.terminate()
+    server.terminate()
+    return elapsed, app_proxy.tracer
+
+
+def replay_to_server(frame_log, args):
+    client = objectclient.ObjectDetectionClient(objectclient.parse_server_addrs(args.server),
+                                                max_in_flight=args.max_in_flight)
+    tracer = tracing.Tracer('object server round trip')
+    done = threading.Semaphore(0)
+
+    def _on_result(trace, response):
+        tracer.finish(trace)
+        done.release()
+
+    start_time = time.time()
+    for frame in paced(frame_log, args.realtime):
+        client.submit(frame, functools.partial(_on_result, tracer.new_frame()))
+    for _ in xrange(len(frame_log)):
+        done.acquire()
+    elapsed = time.time() - start_time
+
+    client.close()
+    return elapsed, tracer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', help='directory recorded with DISKTRAY_RECORD_PATH')
+    parser.add_argument('--mode', choices=('proxy', 'server'), default='proxy')
+    parser.add_argument('--server', default=config.TASK_SERVERS,
+                        help='comma separated object server addresses in server mode')
+    parser.add_argument('--realtime', action='store_true', help='send the frames at the recorded frame rate')
+    parser.add_argument('--max-in-flight', type=int, default=config.TASK_SERVER_MAX_IN_FLIGHT,
+                        help='frames in flight per object server')
+    parser.add_argument('--detection-delay', type=float, default=0,
+                        help='milliseconds the stand-in object server spends on every frame in proxy mode')
+    parser.add_argument('--queue-size', type=int, default=2, help='size of the image queue in proxy mode')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for a result')
+    args = parser.parse_args()
+
+    frame_log = replay.FrameLog(args.recording)
+    if len(frame_log) == 0:
+        sys.exit('{} has no frames'.format(args.recording))
+    print('{} frames recorded at {:.1f} fps'.format(len(frame_log), frame_log.frame_rate))
+
+    if args.mode == 'proxy':
+        elapsed, tracer = replay_to_proxy(frame_log, args)
+    else:
+        elapsed, tracer = replay_to_server(frame_log, args)
+    frame_log.close()
+
+    print('{} frames in {:.2f} s: {:.1f} fps'.format(len(frame_log), elapsed, len(frame_log) / elapsed))
+    print(tracer.format_summary())
+
+
+if __name__ == '__main__':
+    main()